@@ -22,19 +22,34 @@
 """
 
 import argparse
-import copy
+import atexit
+import fcntl
+import glob
+import hashlib
+import io
 import json
 import os
 import pickle
 import re
+import shutil
+import signal
+import socket
+import socketserver
+import stat
 import sys
+import tarfile
+import tempfile
 import time
+import traceback
+import zipfile
 
 from configparser import ConfigParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from fnmatch import fnmatch
 from pathlib import Path
 from queue import Queue
-from subprocess import Popen, PIPE
-from threading import Thread, Lock
+from subprocess import Popen, PIPE, TimeoutExpired
+from threading import Thread, Lock, Condition, current_thread
 from urllib.parse import urlparse
 import xmlrpc.client as xmlrpclib
 
@@ -48,59 +63,681 @@ LOCAL_AFTERPKG_DIR = LOCAL_HOME_DIR / ".afterpkg"
 SCRIPTS_DIR = Path(os.path.expanduser(f"~/.{PROGNAME}/scripts"))
 PYPI_PICKLE = Path(os.path.expanduser(f"~/.{PROGNAME}/pypi.pickle"))
 
-BOT_STATUS_DIR = Path(os.path.expanduser(f"~/.{PROGNAME}"))
+STATS_FILE = Path(os.path.expanduser(f"~/.{PROGNAME}/stats.json"))
+HOST_STATS_FILE = Path(os.path.expanduser(f"~/.{PROGNAME}/hosts.json"))
+HOSTS_CONF = Path(os.path.expanduser(f"~/.{PROGNAME}/hosts.conf"))
+TIMEOUTS_CONF = Path(os.path.expanduser(f"~/.{PROGNAME}/timeouts.conf"))
+STATUS_SOCKET = Path(os.path.expanduser(f"~/.{PROGNAME}/status.sock"))
+JOURNAL_FILE = Path(os.path.expanduser(f"~/.{PROGNAME}/journal.log"))
+DAEMON_SOCKET = Path(os.path.expanduser(f"~/.{PROGNAME}/daemon.sock"))
+INDEX_FILE = Path(os.path.expanduser(f"~/.{PROGNAME}/index.pickle"))
+PONCE_ARCHIVE_URL = "https://github.com/Ponce/slackbuilds/archive/current.zip"
 
 
 # Can be local or remote
 INSTALLED_PACKAGES_DIR = Path("/var/lib/pkgtools/packages")
 BOT_WORKING_DIRS = Path(f"~/.{PROGNAME}/bots")
+REAP_DIR = Path(f"~/.{PROGNAME}/reap")
+OUTPUT_DIRS = Path(f"~/.{PROGNAME}/output")
+REMOTE_PIDS_DIR = Path(f"~/.{PROGNAME}/pids")
+STAGING_DIR = Path(f"~/.{PROGNAME}/staging")
 DOWNLOAD_PKG_DIR = Path(f"~/.{PROGNAME}/downloads")
 
+
+
+class TrackedLock:
+    """A Lock that remembers which thread holds it, so the status report can show it"""
+    def __init__(self):
+        self.lock = Lock()
+        self.holder = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.holder = current_thread().name
+
+    def __exit__(self, _type, value, traceback):
+        self.holder = None
+        self.lock.release()
+
+
 # Use for both the installpkg and pip install steps.
-INSTALLER_LOCK = Lock()
-DOWNLOAD_LOCK = Lock()
+INSTALLER_LOCK = TrackedLock()
 
 
-# Remote host to talk to, if requested on the command-line
-g_ssh_host = None
-# ssh (and scp) port
-g_ssh_port = 22
+def parse_rate(text):
+    """A wget style rate, '500k' or '2m', in bytes per second"""
+    multipliers = {"k": 1024, "m": 1024 * 1024, "g": 1024 * 1024 * 1024}
+    text = text.strip().lower()
+    if text and text[-1] in multipliers:
+        return int(float(text[:-1]) * multipliers[text[-1]])
+    return int(text)
 
 
-def get_remote_command(command):
+class DownloadLimiter:
     """
-        Return the command to be executed, taking into account g_ssh_host, g_ssh_port settings.
+        Decides when a bot may start a download.  At most total downloads run at once, and at most perhost to
+        any one host, less for hosts given a lower 'connections' in hosts.conf (section names are host globs,
+        e.g. [*.sourceforge.net]).  If a bandwidth ceiling is set it's split evenly between the total download
+        slots, and acquire() returns a slot's share in bytes per second.  A rate can't be changed once wget has
+        started, so this is what keeps the downloads running at once under the ceiling however many there are.
     """
-    if g_ssh_host:
-        command = f'ssh -p {g_ssh_port} {g_ssh_host} "{command}"'
-    else:
-        command = command.replace("~", str(LOCAL_HOME_DIR))
-    return command
+    def __init__(self):
+        self.cond = Condition()
+        self.active = {}
+        self.configure(1, 1)
+
+    def configure(self, total, perhost, bandwidth=None, hosts_conf=None):
+        self.total = total
+        self.perhost = perhost
+        self.bandwidth = bandwidth
+        self.host_limits = {}
+        if hosts_conf and hosts_conf.exists():
+            cfg = ConfigParser()
+            cfg.read(hosts_conf)
+            for section in cfg.sections():
+                self.host_limits[section] = cfg.getint(section, "connections", fallback=perhost)
+
+    def limit(self, host):
+        for pattern, connections in self.host_limits.items():
+            if fnmatch(host, pattern):
+                return connections
+        return self.perhost
+
+    def acquire(self, host):
+        with self.cond:
+            while (sum(len(names) for names in self.active.values()) >= self.total or
+                   len(self.active.get(host, [])) >= self.limit(host)):
+                self.cond.wait()
+            self.active.setdefault(host, []).append(current_thread().name)
+            if self.bandwidth:
+                return max(1, self.bandwidth // self.total)
+            return None
+
+    def release(self, host):
+        with self.cond:
+            self.active[host].remove(current_thread().name)
+            if not self.active[host]:
+                del self.active[host]
+            self.cond.notify_all()
+
+    def snapshot(self):
+        """{host: [thread names]} of the downloads in progress"""
+        with self.cond:
+            return {host: list(names) for host, names in self.active.items()}
+
+
+DOWNLOADS = DownloadLimiter()
+
+
+def parse_duration(text):
+    """Seconds in '90', '30m', '2h' or '1d'"""
+    multipliers = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+    text = text.strip().lower()
+    if text and text[-1] in multipliers:
+        return float(text[:-1]) * multipliers[text[-1]]
+    return float(text)
+
+
+class StepTimeouts:
+    """
+        How long each step of a job (download, build, install, pip, publish) may run, and how long any of them may
+        go without printing anything ('idle'), before it's killed.  The defaults come from the command-line, and
+        timeouts.conf can override them per package: section names are package globs, e.g. [texlive] with
+        build = 10h.  0 or nothing means no limit.
+    """
+    def __init__(self):
+        self.configure({})
+
+    def configure(self, defaults, timeouts_conf=None):
+        self.defaults = defaults
+        self.overrides = []
+        if timeouts_conf and timeouts_conf.exists():
+            cfg = ConfigParser()
+            cfg.read(timeouts_conf)
+            for section in cfg.sections():
+                self.overrides.append((section, {key: parse_duration(value) for key, value in cfg[section].items()}))
+
+    def limits(self, package, step):
+        """(timeout, idle) seconds for package's step, None for no limit"""
+        values = dict(self.defaults)
+        for pattern, override in self.overrides:
+            if fnmatch(package, pattern):
+                values.update(override)
+                break
+        return values.get(step) or None, values.get("idle") or None
 
 
-def put_file_to_remote(src, dest):
+TIMEOUTS = StepTimeouts()
+WATCHDOG_POLL_SECONDS = 1.0
+
+
+def output_thread(fp, output):
+    """
+        read from fp and pass each line to output, until eof.
+    """
+    while True:
+        text = fp.readline()
+        if not text:
+            break
+        output(text)
+
+
+class ChildProcesses:
+    """
+        The commands running, so they can be killed when afterpkg is.  They each get a process group of their own,
+        away from the terminal's, so Ctrl-C wouldn't otherwise reach them.
     """
-        Return the command to copy directory of files locally or remotely depending on g_ssh_host setting
+    def __init__(self):
+        self.lock = Lock()
+        self.killers = {}
+
+    def add(self, pid, killer):
+        with self.lock:
+            self.killers[pid] = killer
+
+    def remove(self, pid):
+        with self.lock:
+            self.killers.pop(pid, None)
+
+    def kill_all(self):
+        with self.lock:
+            killers = list(self.killers.values())
+            self.killers.clear()
+        for killer in killers:
+            killer()
+
+
+CHILDREN = ChildProcesses()
+
+
+def execute(command, stdin_text=None, output=None, timeout=None, idle=None, cleanup=None):
+    """
+        Execute a shell command, passing its stdout and stderr lines to output.  Raise OSError on failure.  If it
+        runs for longer than timeout seconds, or goes idle seconds without any output, the command and everything
+        it started is killed and TimeoutError raised.  cleanup is called whenever the command gets killed, to kill
+        anything it started that its process group doesn't cover (on a remote host, say).
     """
-    dest = str(dest)
-    if g_ssh_host:
-        if dest.startswith("~/"):
-            dest = dest[2:]
-        command = f"scp -P {g_ssh_port} -r {src} {g_ssh_host}:{dest}"
+
+    if stdin_text:
+        stdin_pipe = PIPE
     else:
-        command = f"cp -r {src} {dest}"
-    return command
+        stdin_pipe = None
+
+    if output is None:
+        output = lambda text: None
+
+    # Its own process group, so a timeout can take out whatever it started along with it.
+    p = Popen(command, stdout=PIPE, stderr=PIPE, stdin=stdin_pipe, shell=True, bufsize=0, start_new_session=True)
+
+    def kill():
+        if cleanup:
+            cleanup()
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    CHILDREN.add(p.pid, kill)
+    try:
+        watch(p, command, stdin_text, output, timeout, idle, kill)
+    finally:
+        CHILDREN.remove(p.pid)
+    if p.returncode != 0:
+        raise OSError("Error executing %r" % command)
+
+
+def watch(p, command, stdin_text, output, timeout, idle, kill):
+    """
+        Feed process p stdin_text and pass its output on until it finishes, calling kill and raising TimeoutError
+        if it hangs.
+    """
+    start = last_output = time.time()
+
+    def watched(text):
+        nonlocal last_output
+        last_output = time.time()
+        output(text)
+
+    # These threads only exist as long as the command
+    sout = Thread(target=output_thread, args=(p.stdout, watched))
+    sout.daemon = True
+    sout.start()
+
+    serr = Thread(target=output_thread, args=(p.stderr, watched))
+    serr.daemon = True
+    serr.start()
+
+    if stdin_text:
+        p.stdin.write(stdin_text)
+        p.stdin.close()
+
+    while sout.is_alive() or serr.is_alive() or p.poll() is None:
+        now = time.time()
+        reason = None
+        if timeout and now - start > timeout:
+            reason = "still running after %ds" % timeout
+        elif idle and now - last_output > idle:
+            reason = "no output for %ds" % idle
+        if reason:
+            kill()
+            p.wait()
+            raise TimeoutError("Killed %r, %s" % (command, reason))
+        if sout.is_alive():
+            sout.join(WATCHDOG_POLL_SECONDS)
+        elif serr.is_alive():
+            serr.join(WATCHDOG_POLL_SECONDS)
+        else:
+            try:
+                p.wait(WATCHDOG_POLL_SECONDS)
+            except TimeoutExpired:
+                pass
+
+
+class ExecutionBackend:
+    """
+        Where commands get run.  Subclasses decide how a command reaches the target, the rest of the code only
+        deals in commands as they'd be typed on the target.
+    """
+    # Simulated backends don't really run anything, so nothing they time is worth recording.
+    simulated = False
+
+    def wrap(self, command):
+        """Return the command as it will actually be executed"""
+        return command
+
+    def query(self, command):
+        """
+            Run a command and fetch the output, don't care about return code.  Use this only when you don't care
+            about the result, e.g. md5sum will give either the correct md5 or something else, we don't care what.
+        """
+        p = Popen(self.wrap(command), stdout=PIPE, stderr=PIPE, shell=True)
+        sout, _ = p.communicate(b'')
+        return sout.decode("utf-8")
+
+    def run(self, command, stdin_text=None, output=None, package=None, timeout=None, idle=None):
+        """
+            Run a command, output gets each line of its output.  package is the package it's being run for.
+            timeout and idle are as for execute().
+        """
+        execute(self.wrap(command), stdin_text, output, timeout, idle)
+
+    # Filesystem operations on the target, done here with shell commands.  Backends that can do them directly
+    # override these.  output is as for run(), so the changes made show up with -d.
+
+    def list_dir(self, path):
+        """The names in a directory, none if it doesn't exist"""
+        return [name for name in self.query(f"ls {path}").split("\n") if name]
+
+    def exists(self, path):
+        return bool(self.query(f"ls {path}").strip())
+
+    def md5(self, path):
+        """Get the checksum of the passed path or None if non-existent"""
+        rex = re.compile(r"^([a-f0-9]{32})\s+(\S+)$")
+        for line in self.query(f"md5sum {path}").split("\n"):
+            m = rex.match(line.strip())
+            if m:
+                return m.group(1)
+        return None
+
+    def checksums(self, root):
+        """{path relative to root: md5} of every file under root"""
+        rex = re.compile(r"^([a-f0-9]{32})\s+\./(\S+)$")
+        out = {}
+        for line in self.query(f"cd {root} && find . -type f -exec md5sum {{}} +").split("\n"):
+            m = rex.match(line.strip())
+            if m:
+                out[m.group(2)] = m.group(1)
+        return out
+
+    def file_size(self, path):
+        size = self.query(f"stat -c %s {path}").strip()
+        return int(size) if size.isdigit() else 0
+
+    def read_text(self, *paths):
+        """The contents of the files that exist of paths, one after the other"""
+        return self.query("cat %s" % " ".join(str(path) for path in paths))
+
+    def remove_tree(self, *paths, output=None):
+        """rm -rf, paths can be globs"""
+        self.run("rm -rf %s" % " ".join(str(path) for path in paths), output=output)
+
+    def make_dirs(self, *paths, output=None):
+        self.run("mkdir -p %s" % " ".join(str(path) for path in paths), output=output)
+
+    def copy_tree(self, src, dest, output=None):
+        self.run(f"cp -r {src} {dest}", output=output)
+
+    def copy_file(self, src, dest, output=None):
+        self.run(f"cp {src} {dest}", output=output)
+
+    def link_files(self, pairs, output=None):
+        """
+            Put each (src, dest) file in place as a hardlink, or a reflink where hardlinks can't be made (a
+            different filesystem), falling back to a plain copy where neither is possible.
+        """
+        commands = [f"ln -f {src} {dest} 2>/dev/null || cp --reflink=auto {src} {dest}" for src, dest in pairs]
+        if commands:
+            self.run(" && ".join(commands), output=output)
+
+    def move(self, src, dest):
+        """Move src to dest, making dest's directory if needed, nothing if there's no src"""
+        self.query(f"mkdir -p {dest.parent} && mv {src} {dest}")
+
+    def extract_tar(self, data, dest, clear=(), output=None):
+        """Unpack the gzipped tar data into dest, first removing the directories in clear"""
+        command = f"mkdir -p {dest} && tar -xzf - -C {dest}"
+        if clear:
+            command = "rm -rf " + " ".join(str(path) for path in clear) + " && " + command
+        self.run(command, data, output)
+
+
+class LocalBackend(ExecutionBackend):
+    """
+        Run everything on this host.  The filesystem operations are done in-process, only things like the builds,
+        installpkg, wget and pip get a shell.
+    """
+    # ioctl to clone a file's extents, for filesystems that can (btrfs, xfs).
+    FICLONE = 0x40049409
+
+    def wrap(self, command):
+        return command.replace("~", str(LOCAL_HOME_DIR))
+
+    def local(self, path):
+        return Path(self.wrap(str(path)))
+
+    def list_dir(self, path):
+        try:
+            return sorted(os.listdir(self.local(path)))
+        except OSError:
+            return []
+
+    def exists(self, path):
+        return self.local(path).exists()
+
+    def md5(self, path):
+        digest = hashlib.md5()
+        try:
+            with self.local(path).open("rb") as fp:
+                for block in iter(lambda: fp.read(1 << 20), b""):
+                    digest.update(block)
+        except OSError:
+            return None
+        return digest.hexdigest()
+
+    def checksums(self, root):
+        root = self.local(root)
+        return {str(path.relative_to(root)): self.md5(path) for path in root.rglob("*") if path.is_file()}
+
+    def file_size(self, path):
+        try:
+            return self.local(path).stat().st_size
+        except OSError:
+            return 0
+
+    def read_text(self, *paths):
+        out = []
+        for path in paths:
+            try:
+                out.append(self.local(path).read_text())
+            except OSError:
+                pass
+        return "".join(out)
+
+    def remove_tree(self, *paths, output=None):
+        for pattern in paths:
+            for path in glob.glob(str(self.local(pattern))):
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.unlink(path)
+
+    def make_dirs(self, *paths, output=None):
+        for path in paths:
+            self.local(path).mkdir(parents=True, exist_ok=True)
+
+    def copy_tree(self, src, dest, output=None):
+        shutil.copytree(self.local(src), self.local(dest), dirs_exist_ok=True)
+
+    def copy_file(self, src, dest, output=None):
+        shutil.copy(self.local(src), self.local(dest))
+
+    def link_files(self, pairs, output=None):
+        for src, dest in pairs:
+            src, dest = self.local(src), self.local(dest)
+            dest.unlink(missing_ok=True)
+            try:
+                os.link(src, dest)
+                continue
+            except OSError:
+                pass
+            try:
+                with src.open("rb") as fin, dest.open("wb") as fout:
+                    fcntl.ioctl(fout.fileno(), self.FICLONE, fin.fileno())
+            except OSError:
+                shutil.copyfile(src, dest)
+            shutil.copymode(src, dest)
+
+    def move(self, src, dest):
+        src, dest = self.local(src), self.local(dest)
+        if src.exists():
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            src.rename(dest)
+
+    def extract_tar(self, data, dest, clear=(), output=None):
+        self.remove_tree(*clear)
+        dest = self.local(dest)
+        dest.mkdir(parents=True, exist_ok=True)
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar:
+            tar.extractall(dest)
+
+
+class SshBackend(ExecutionBackend):
+    """Run everything on a remote host over ssh"""
+    def __init__(self, host, port=22):
+        self.host = host
+        self.port = port
+
+    def wrap(self, command):
+        return f'ssh -p {self.port} {self.host} "{command}"'
+
+    def run(self, command, stdin_text=None, output=None, package=None, timeout=None, idle=None):
+        """
+            Killing the local ssh leaves the command running on the target, so the remote shell notes its pid, which
+            sshd made a session and process group leader, and the whole group is killed over another connection.
+        """
+        pid_file = REMOTE_PIDS_DIR / f"{os.getpid()}-{current_thread().name}"
+        remote = f"mkdir -p {REMOTE_PIDS_DIR}; echo \\$\\$ > {pid_file}; {command}"
+        execute(self.wrap(remote), stdin_text, output, timeout, idle,
+                lambda: self.query(f"kill -KILL -\\$(cat {pid_file})"))
+
+
+class SimulatedBackend(ExecutionBackend):
+    """
+        Pretend to run everything.  Commands are interpreted against an in-memory model of the target filesystem,
+        so downloads, builds and installs leave behind the files the later steps look for.  Builds, downloads and
+        installs take the time given in durations ({package: {step: seconds}}) divided by speedup.  If shown is
+        given, the commands are echoed as that backend would have run them (this is how -d works).
+    """
+    simulated = True
+    memory_mb = 16384
+
+    def __init__(self, shown=None, durations=None, speedup=1.0):
+        self.shown = shown
+        self.durations = durations or {}
+        self.speedup = speedup
+        self.files = {}
+        self.lock = Lock()
+        self.proc = {
+            "/proc/meminfo": f"MemTotal: {self.memory_mb * 1024} kB\nMemAvailable: {self.memory_mb * 1024} kB\n",
+            "/proc/loadavg": "0.00 0.00 0.00 1/100 1\n",
+        }
+
+    def wrap(self, command):
+        if self.shown:
+            return self.shown.wrap(command)
+        return command
+
+    def duration(self, package, step):
+        return self.durations.get(package, {}).get(step, 0.0) / self.speedup
+
+    def list(self, pattern):
+        """ls: the entries of a directory, or the paths matching a glob"""
+        prefix = pattern.rstrip("/") + "/"
+        children = set()
+        matches = []
+        for path in self.files:
+            if path.startswith(prefix):
+                children.add(path[len(prefix):].partition("/")[0])
+            elif fnmatch(path, pattern):
+                matches.append(path)
+        if children:
+            return sorted(children)
+        return sorted(matches)
+
+    def remove(self, path):
+        for name in [name for name in self.files if name == path or name.startswith(path + "/")]:
+            del self.files[name]
+
+    def copy(self, src, dest):
+        if src in self.files:
+            self.files[dest] = self.files[src]
+            return
+        for name in [name for name in self.files if name.startswith(src + "/")]:
+            self.files[dest + name[len(src):]] = self.files[name]
+
+    def build(self, wrapper, package, output="/tmp", pkgtype="tgz"):
+        """
+            Leave a package where get_built_package_location() will look for it, named with the VERSION of the .info
+            file copied into the working directory alongside the wrapper.
+        """
+        info = self.files.get(f"{Path(wrapper).parent}/{package}.info", b"").decode("utf-8", "replace")
+        m = re.search(r'^VERSION="?([^"\n]*)"?$', info, re.M)
+        version = m.group(1).strip() if m else "0"
+        self.files[f"{output}/{package}-{version}-x86_64-1_SBo.{pkgtype}"] = b""
+
+    def extract(self, stdin_text, dest):
+        """tar -x of stdin_text into dest"""
+        with tarfile.open(fileobj=io.BytesIO(stdin_text or b""), mode="r:*") as tar:
+            for member in tar.getmembers():
+                if member.isfile():
+                    self.files[f"{dest}/{member.name}"] = tar.extractfile(member).read()
+
+    def apply(self, words, stdin_text, package, env=None):
+        """Make the change a single command would have made, return how long it would have taken"""
+        env = dict(env or {})
+        while words and "=" in words[0]:
+            name, _, value = words[0].partition("=")
+            env[name] = value
+            words = words[1:]
+        if not words:
+            return 0.0
+        if words[0] == "rm":
+            for path in words[2:]:
+                self.remove(path)
+        elif words[0] == "tar":
+            self.extract(stdin_text, words[words.index("-C") + 1])
+        elif words[0] in ["cp", "ln"]:
+            self.copy(words[-2], words[-1])
+        elif words[0] == "mv":
+            self.copy(words[-2], words[-1])
+            self.remove(words[-2])
+        elif words[0] == "dd":
+            self.files[words[1].partition("=")[2]] = stdin_text or b""
+        elif words[0] == "wget":
+            self.files[words[words.index("-O") + 1]] = ("simulated download of %s" % words[-1]).encode("utf-8")
+            return self.duration(package, "download")
+        elif words[0] == "sh" and words[1] == str(STAGING_DIR / PEAK_SCRIPT):
+            peak_kb = self.durations.get(package, {}).get("peak_mb", 0) * 1024
+            self.files[words[2]] = b"%d\n" % peak_kb
+            return self.apply(words[3:], stdin_text, package, env)
+        elif words[0] == "sh" and words[1] != "-s":
+            self.build(words[1], package, env.get("OUTPUT", "/tmp"), env.get("PKGTYPE", "tgz"))
+            return self.duration(package, "build")
+        elif words[0] == "installpkg":
+            name = Path(words[1]).name.rpartition(".")[0]
+            self.files[str(INSTALLED_PACKAGES_DIR / name)] = b""
+            return self.duration(package, "install")
+        return 0.0
+
+    def query(self, command):
+        words = command.split()
+        with self.lock:
+            if words[0] == "md5sum":
+                if words[1] in self.files:
+                    return "%s  %s\n" % (hashlib.md5(self.files[words[1]]).hexdigest(), words[1])
+                return ""
+            if words[0] == "ls":
+                return "".join(path + "\n" for path in self.list(words[1]))
+            if words[0] == "cat":
+                return "".join(self.proc.get(path, self.files.get(path, b"").decode("utf-8")) for path in words[1:])
+            if words[0] == "stat":
+                if words[-1] in self.files:
+                    return "%d\n" % len(self.files[words[-1]])
+                return ""
+            if words[0].startswith("pip"):
+                return "[]"
+            self.apply(words, None, None)
+        return ""
+
+    def run(self, command, stdin_text=None, output=None, package=None, timeout=None, idle=None):
+        if self.shown and output:
+            if stdin_text:
+                output(f"cat <script> | {self.wrap(command)}\n".encode("utf-8"))
+            else:
+                output(f"{self.wrap(command)}\n".encode("utf-8"))
+        duration = 0.0
+        with self.lock:
+            for part in command.split("&&"):
+                # Only the first of any alternatives, and no redirections
+                words = [word for word in part.split("||")[0].split() if not word.startswith("2>")]
+                if words:
+                    duration += self.apply(words, stdin_text, package)
+        # Timeouts are in real seconds, durations are already sped up.
+        if timeout and duration * self.speedup > timeout:
+            time.sleep(timeout / self.speedup)
+            raise TimeoutError("Killed %r, still running after %ds" % (command, timeout))
+        if duration:
+            time.sleep(duration)
+
+
+# Where commands run, set from the command-line
+g_backend = LocalBackend()
 
 
 def remote_popen(command):
     """
-        Run a command and fetch the output, don't care about return code.  Use this only when you don't care about the
-        result, e.g. md5sum will give either the correct md5 or something else, we don't care what.
+        Run a command on the target and fetch the output, don't care about return code.
     """
-    command = get_remote_command(command)
-    p = Popen(command, stdout=PIPE, stderr=PIPE, shell=True)
-    sout, _ = p.communicate(b'')
-    return sout.decode("utf-8")
+    return g_backend.query(command)
+
+
+STATS_LOCK = Lock()
+
+
+def load_stats():
+    """Recorded per-package step timings, {package: {step: seconds}}"""
+    if STATS_FILE.exists():
+        return json.loads(STATS_FILE.read_text())
+    return {}
+
+
+def record_stat(package, step, value):
+    """Remember a measurement for package, replacing any earlier one"""
+    with STATS_LOCK:
+        stats = load_stats()
+        stats.setdefault(package, {})[step] = value
+        STATS_FILE.write_text(json.dumps(stats, indent=1, sort_keys=True))
+
+
+def record_host_throughput(host, size, seconds):
+    """Add a download to the running totals for its host, {host: {"bytes": n, "seconds": s}}"""
+    with STATS_LOCK:
+        stats = json.loads(HOST_STATS_FILE.read_text()) if HOST_STATS_FILE.exists() else {}
+        totals = stats.setdefault(host, {"bytes": 0, "seconds": 0.0})
+        totals["bytes"] += size
+        totals["seconds"] += seconds
+        HOST_STATS_FILE.write_text(json.dumps(stats, indent=1, sort_keys=True))
 
 
 def find_scripts_location():
@@ -116,15 +753,6 @@ def find_scripts_location():
     sys.exit(1)
 
 
-class NoOpLock:
-    """A do-nothing context manager"""
-    def __enter__(self):
-        pass
-
-    def __exit__(self, _type, value, traceback):
-        pass
-
-
 def list_all_pypi_packages():
     """
         Download and cache the entire list of packages from pypi.  This takes a couple of seconds but it's cached
@@ -146,7 +774,7 @@ def get_installed_packages():
     """Figure out the list of installed packages, including Slackware core ones.  Return as a set."""
     rex = re.compile("^(.*)-([^-]*)-([^-]*)-([^-]*)$")
     out = set()
-    for line in remote_popen("ls %s" % INSTALLED_PACKAGES_DIR).split("\n"):
+    for line in g_backend.list_dir(INSTALLED_PACKAGES_DIR):
         m = rex.match(line.strip())
         if m:
             out.add(m.group(1))
@@ -154,6 +782,8 @@ def get_installed_packages():
 
 
 g_info_cache = {}
+# .info contents from the persistent index, {path: (mtime_ns, fields)}, only trusted while the mtime matches.
+g_info_index = {}
 
 
 def read_info(path):
@@ -161,6 +791,12 @@ def read_info(path):
     if path in g_info_cache:
         return g_info_cache[path]
 
+    if path in g_info_index:
+        mtime, result = g_info_index[path]
+        if path.stat().st_mtime_ns == mtime:
+            g_info_cache[path] = result
+            return result
+
     cfg = ConfigParser(interpolation=None)
     cfg.optionxform = str
     with path.open("r") as fp:
@@ -187,6 +823,194 @@ def read_info(path):
         return result
 
 
+def package_digest(path):
+    """md5 over the names and contents of everything in a package directory"""
+    digest = hashlib.md5()
+    for item in sorted(path.rglob("*")):
+        if item.is_file():
+            digest.update(str(item.relative_to(path)).encode("utf-8") + b"\0")
+            digest.update(item.read_bytes())
+    return digest.hexdigest()
+
+
+def package_directories(root):
+    """{"category/package": path} for every package directory in a SlackBuilds tree"""
+    out = {}
+    for category in root.iterdir():
+        if not category.is_dir() or category.name.startswith("."):
+            continue
+        for package in category.iterdir():
+            if package.is_dir():
+                out[f"{category.name}/{package.name}"] = package
+    return out
+
+
+class RepositoryIndex:
+    """
+        Persistent index of a SlackBuilds tree, kept up to date by sync_repository().  For each package directory
+        ("category/package") it holds a digest of the contents and the parsed .info file with its mtime, so
+        syncing can tell what changed and startup doesn't have to parse every .info file.  revision is the git
+        commit the tree was last synced from, if it came from a git checkout.
+    """
+    def __init__(self, root):
+        self.root = str(root)
+        self.revision = None
+        self.source = None
+        self.packages = {}
+
+    @staticmethod
+    def load(root):
+        """The saved index for root, or None"""
+        if not INDEX_FILE.exists():
+            return None
+        # Saved as a plain dict, so it loads whether afterpkg is the main script or imported.
+        fields = pickle.loads(INDEX_FILE.read_bytes())
+        if fields["root"] != str(root):
+            return None
+        index = RepositoryIndex(root)
+        index.__dict__.update(fields)
+        return index
+
+    def save(self):
+        temp = INDEX_FILE.with_suffix(".tmp")
+        temp.write_bytes(pickle.dumps(self.__dict__))
+        temp.replace(INDEX_FILE)
+
+    def update(self, key, path):
+        """Re-read the package directory at path"""
+        info = path / (path.name + ".info")
+        entry = {"digest": package_digest(path)}
+        # Whatever was read before the sync is out of date.
+        g_info_cache.pop(info, None)
+        g_info_index.pop(info, None)
+        if info.exists():
+            entry["mtime"] = info.stat().st_mtime_ns
+            entry["info"] = read_info(info)
+        self.packages[key] = entry
+
+    def info_entries(self):
+        """{path of .info: (mtime_ns, fields)} for seeding g_info_index"""
+        root = Path(self.root)
+        return {root / key / (Path(key).name + ".info"): (entry["mtime"], entry["info"])
+                for key, entry in self.packages.items() if "info" in entry}
+
+
+def git_revision(source):
+    """The commit checked out in source, or None if it isn't a git checkout"""
+    if not (source / ".git").exists():
+        return None
+    p = Popen(["git", "-C", str(source), "rev-parse", "HEAD"], stdout=PIPE, stderr=PIPE)
+    sout, _ = p.communicate()
+    return sout.decode("utf-8").strip() or None
+
+
+def git_changed_packages(source, old, new):
+    """The "category/package" directories touched between two commits, or None if git can't tell us"""
+    p = Popen(["git", "-C", str(source), "diff", "--name-only", old, new], stdout=PIPE, stderr=PIPE)
+    sout, _ = p.communicate()
+    if p.returncode != 0:
+        return None
+    out = set()
+    for line in sout.decode("utf-8").split("\n"):
+        parts = line.split("/")
+        if len(parts) >= 3 and not parts[0].startswith("."):
+            out.add("/".join(parts[:2]))
+    return out
+
+
+def unpack_archive(archive, temp):
+    """Unpack a zip or tar of a SlackBuilds tree into temp, return the root of the tree"""
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            zf.extractall(temp)
+    else:
+        with tarfile.open(archive) as tar:
+            tar.extractall(temp)
+    entries = list(Path(temp).iterdir())
+    # Archives from github have everything under slackbuilds-current/
+    if len(entries) == 1 and entries[0].is_dir():
+        return entries[0]
+    return Path(temp)
+
+
+def sync_repository(source, dest):
+    """
+        Bring the SlackBuilds tree at dest up to date with source, which is either a git checkout or a zip/tar
+        archive of a tree.  Only package directories that changed are copied, and only their index entries are
+        refreshed.  Returns the set of package names that were added, changed or removed.
+    """
+    index = RepositoryIndex.load(dest) if dest.exists() else None
+    if index is None:
+        print(f"Indexing {dest}")
+        index = RepositoryIndex(dest)
+        if dest.exists():
+            for key, path in package_directories(dest).items():
+                index.update(key, path)
+
+    with tempfile.TemporaryDirectory(prefix=f"{PROGNAME}-sync-") as temp:
+        source = Path(source)
+        if source.is_file():
+            source = unpack_archive(source, temp)
+
+        revision = git_revision(source)
+        changed = None
+        if revision and index.revision and index.source == str(source.resolve()):
+            changed = git_changed_packages(source, index.revision, revision)
+        if changed is None:
+            # No history to go on, compare the contents.
+            source_dirs = package_directories(source)
+            changed = {key for key, path in source_dirs.items()
+                       if index.packages.get(key, {}).get("digest") != package_digest(path)}
+            changed |= set(index.packages) - set(source_dirs)
+
+        for key in sorted(changed):
+            src_path = source / key
+            dest_path = dest / key
+            if dest_path.exists():
+                shutil.rmtree(dest_path)
+            if src_path.is_dir():
+                shutil.copytree(src_path, dest_path)
+                index.update(key, dest_path)
+            else:
+                index.packages.pop(key, None)
+
+        index.revision = revision
+        index.source = str(source.resolve()) if revision else None
+        index.save()
+
+    return {Path(key).name for key in changed}
+
+
+def affected_packages(index, changed, installed):
+    """
+        Split the installed packages affected by a sync into those that changed themselves, and those that
+        depend (directly or not) on something that changed.
+    """
+    dependents = {}
+    for key, entry in index.packages.items():
+        for dep in entry.get("info", {}).get("REQUIRES", []):
+            dependents.setdefault(dep, set()).add(Path(key).name)
+
+    indirect = set()
+    todo = list(changed)
+    while todo:
+        for dependent in dependents.get(todo.pop(), ()):
+            if dependent not in indirect:
+                indirect.add(dependent)
+                todo.append(dependent)
+    return sorted(changed & installed), sorted((indirect - changed) & installed)
+
+
+def sync_and_report(source, dest):
+    changed = sync_repository(source, dest)
+    print(f"{len(changed)} package directories changed")
+    updated, dependents = affected_packages(RepositoryIndex.load(dest), changed, get_installed_packages())
+    for package in updated:
+        print(f"changed:    {package}")
+    for package in dependents:
+        print(f"depends on: {package}")
+
+
 # Special cases
 sbo_to_pypi_specials = [
     ("python-cheetah",              "Cheetah"),
@@ -217,37 +1041,103 @@ sbo_to_pypi_specials = [
 ]
 
 
+# How long each phase of startup took, [(phase, seconds)], shown with --timing
+g_phase_times = []
+
+
+def timed(phase, func):
+    """Call func, noting how long it took under phase"""
+    start = time.perf_counter()
+    result = func()
+    g_phase_times.append((phase, time.perf_counter() - start))
+    return result
+
+
+class Inventory:
+    """
+        What's already available to satisfy dependencies: the pypi package list, pip-installed packages for py2
+        and py3, and the installed Slackware packages.  Each can be given as a function, in which case it's only
+        called the first time it's needed, so a run that never looks at (say) pip doesn't pay for asking.
+    """
+    def __init__(self, pypi_all, pypi_local_py2, pypi_local_py3, slack_pkg_local):
+        self.sources = {"pypi_all": pypi_all, "pypi_local_py2": pypi_local_py2, "pypi_local_py3": pypi_local_py3,
+                        "slack_pkg_local": slack_pkg_local}
+        self.values = {}
+        self.lock = Lock()
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.values:
+                source = self.sources[name]
+                self.values[name] = set(source() if callable(source) else source)
+            return self.values[name]
+
+    def forget(self, *names):
+        """Fetch these again next time they're needed, e.g. the installed packages after a build"""
+        with self.lock:
+            for name in names:
+                self.values.pop(name, None)
+
+    pypi_all = property(lambda self: self.get("pypi_all"))
+    pypi_local_py2 = property(lambda self: self.get("pypi_local_py2"))
+    pypi_local_py3 = property(lambda self: self.get("pypi_local_py3"))
+    slack_pkg_local = property(lambda self: self.get("slack_pkg_local"))
+
+
+def probe_inventory():
+    """An Inventory that asks pypi (or the cache) and the target host, as and when it's needed"""
+    return Inventory(lambda: timed("pypi list", list_all_pypi_packages),
+                     lambda: timed("pip list", lambda: DependencyManager.list_local_pip_packages("")),
+                     lambda: timed("pip3 list", lambda: DependencyManager.list_local_pip_packages("3")),
+                     lambda: timed("installed packages", get_installed_packages))
+
+
 class DependencyManager:
-    def __init__(self, path, novirtual):
-        """path is the root of slackbuilds"""
+    def __init__(self, path, novirtual, inventory=None, nopip2=False, nopip3=False):
+        """path is the root of slackbuilds, inventory defaults to probing pypi and the target"""
 
         if not path.exists():
             print("No slackbuilds directory found at %s." % path)
-            cmnd = f"wget -O ~/.{PROGNAME}/slackbuilds.zip https://github.com/Ponce/slackbuilds/archive/current.zip"
-            os.system(cmnd)
-            cmnd = f"unzip -d ~/.{PROGNAME} ~/.{PROGNAME}/slackbuilds.zip"
-            os.system(cmnd)
-            os.system(f"mv ~/.{PROGNAME}/slackbuilds-current ~/.{PROGNAME}/slackbuilds")
+            archive = LOCAL_AFTERPKG_DIR / "slackbuilds.zip"
+            os.system(f"wget -O {archive} {PONCE_ARCHIVE_URL}")
+            sync_repository(archive, path)
 
         self.ignore = {"%README%", ""}
-        self.package_dirs = {}
-        self.pySBo_all = set()
+        self.scan(path)
+
+        if inventory is None:
+            inventory = probe_inventory()
+        self.inventory = inventory
+        self.py_rex = re.compile("^(python3?-)(.*)$")
+        self.pip_rex = re.compile("^python(3?)-(.*)$")
+        self.novirtual = novirtual
+        self.nopip2 = nopip2 or novirtual
+        self.nopip3 = nopip3 or novirtual
+
+    def scan(self, path):
+        """Find the package directories, again if the tree has changed"""
+        index = RepositoryIndex.load(path)
+        if index:
+            g_info_index.update(index.info_entries())
+
+        package_dirs = {}
+        pySBo_all = set()
         for category in path.iterdir():
             if not category.is_dir() or category.name.startswith("."):
                 continue
             for package in category.iterdir():
                 name = package.name
-                self.package_dirs[name] = package
+                package_dirs[name] = package
                 if name.startswith("python-") or name.startswith("python3-"):
-                    self.pySBo_all.add(name)
+                    pySBo_all.add(name)
+        self.package_dirs = package_dirs
+        self.pySBo_all = pySBo_all
 
-        self.pypi_all = list_all_pypi_packages()
-        self.pypi_local_py2 = self.list_local_pip_packages("")
-        self.pypi_local_py3 = self.list_local_pip_packages("3")
-        self.slack_pkg_local = get_installed_packages()
-        self.py_rex = re.compile("^(python3?-)(.*)$")
-        self.pip_rex = re.compile("^python(3?)-(.*)$")
-        self.novirtual = novirtual
+    # Fetched from the inventory when first used.
+    pypi_all = property(lambda self: self.inventory.pypi_all)
+    pypi_local_py2 = property(lambda self: self.inventory.pypi_local_py2)
+    pypi_local_py3 = property(lambda self: self.inventory.pypi_local_py3)
+    slack_pkg_local = property(lambda self: self.inventory.slack_pkg_local)
 
     @staticmethod
     def list_local_pip_packages(version):
@@ -338,16 +1228,15 @@ class DependencyManager:
         """
         if sbo_name in self.slack_pkg_local:
             return True
-        if self.novirtual:
-            return False
-        pip_pkg = self.sbo_to_pypi(sbo_name)
-        if pip_pkg:
-            if sbo_name.startswith("python3-"):
-                if pip_pkg in self.pypi_local_py3:
-                    return True
-            if sbo_name.startswith("python-"):
-                if pip_pkg in self.pypi_local_py2:
-                    return True
+        # Only ask pip (or pypi) about packages it could have installed.
+        if sbo_name.startswith("python3-") and not self.nopip3:
+            pip_pkg = self.sbo_to_pypi(sbo_name)
+            if pip_pkg and pip_pkg in self.pypi_local_py3:
+                return True
+        if sbo_name.startswith("python-") and not self.nopip2:
+            pip_pkg = self.sbo_to_pypi(sbo_name)
+            if pip_pkg and pip_pkg in self.pypi_local_py2:
+                return True
         return False
 
     def lookup_deps(self, pkg, remove_local=True):
@@ -398,6 +1287,10 @@ class DependencyManager:
         """Get the path to the SBo SlackBuild Directory"""
         return self.package_dirs[name]
 
+    def get_version(self, name):
+        """The VERSION in the package's .info file"""
+        return read_info(self.get_source_location(name) / (name + ".info"))["VERSION"]
+
     def is_sbo_pkg(self, pkg):
         """Is the package an SBo one?"""
         return pkg in self.package_dirs
@@ -434,102 +1327,119 @@ class ScriptManager:
             return self.requires[package]
 
 
-def output_thread(fp, console_q, package, bot_index):
-    """
-        read from fp, tag the data and put it on the console queue.  package and bot_index are just passed on
-        after eof, signal we're done on quit_q.
-    """
-    while True:
-        text = fp.readline()
-        if not text:
-            break
-        console_q.put((text, package, bot_index))
-
-
-def get_built_package_location(name, info_dict):
-    command = f"ls /tmp/{name}-" + info_dict["VERSION"] + "-*"
+def get_built_package_location(backend, name, info_dict, output_dir):
+    """The package the build left in its own (emptied beforehand) output_dir"""
+    prefix = f"{name}-" + info_dict["VERSION"] + "-"
     out = []
-    for path in remote_popen(command).split("\n"):
-        if not path:
-            continue
-        out.append(path)
+    for file_name in backend.list_dir(output_dir):
+        if file_name.startswith(prefix) and re.search(r"\.t[gbxl]z$", file_name):
+            out.append(output_dir / file_name)
     if len(out) == 1:
         return out[0]
     raise ValueError("Unable to find built package location, build may have failed.")
 
 
+# Files a built package into the repository: the package itself, and the fragments that go into the repository
+# index, written last so assemble_repository() only sees complete ones.  The fragments are kept in .fragments, out
+# of the tree that gets mirrored.  Older versions are removed.
+publish_template = """set -e
+NAME=%(package)s
+FRAGMENTS=%(repository)s/.fragments/%(category)s
+mkdir -p %(repository)s/%(category)s "$FRAGMENTS"
+cd %(repository)s/%(category)s
+for old in "$NAME"-*.t?z; do
+  [ -e "$old" ] || continue
+  [ "${old%%-*-*-*}" = "$NAME" ] || continue
+  rm -f "$old" "${old%%.t?z}.txt" "$FRAGMENTS/${old%%.t?z}.md5" "$FRAGMENTS/${old%%.t?z}.meta"
+done
+cp %(artifact)s .
+FILE=$(basename %(artifact)s)
+BASE=${FILE%%.t?z}
+{ tar -xOf "$FILE" install/slack-desc || tar -xOf "$FILE" ./install/slack-desc; } 2>/dev/null |
+  grep "^$NAME:" > "$BASE.txt" || true
+md5sum "$FILE" "$BASE.txt" | sed "s|  |  ./%(category)s/|" > "$FRAGMENTS/$BASE.md5"
+{
+  echo "PACKAGE NAME:  $FILE"
+  echo "PACKAGE LOCATION:  ./%(category)s"
+  echo "PACKAGE SIZE (compressed):  $(du -k "$FILE" | cut -f1) K"
+  echo "PACKAGE SIZE (uncompressed):  $(tar -tvf "$FILE" | awk '{s+=$3} END {print int(s/1024)}') K"
+  echo "PACKAGE REQUIRED:  %(required)s"
+  echo "PACKAGE DESCRIPTION:"
+  cat "$BASE.txt"
+  echo
+} > "$FRAGMENTS/$BASE.meta.tmp"
+mv "$FRAGMENTS/$BASE.meta.tmp" "$FRAGMENTS/$BASE.meta"
+"""
+
+
+# Put the per-package fragments together into PACKAGES.TXT and CHECKSUMS.md5
+assemble_template = """set -e
+cd %(repository)s
+{
+  echo "PACKAGES.TXT;  $(date)"
+  echo
+  cat .fragments/*/*.meta 2>/dev/null || true
+} > PACKAGES.TXT.tmp
+mv PACKAGES.TXT.tmp PACKAGES.TXT
+{
+  cat .fragments/*/*.md5 2>/dev/null || true
+  md5sum PACKAGES.TXT | sed "s|  |  ./|"
+} > CHECKSUMS.md5.tmp
+mv CHECKSUMS.md5.tmp CHECKSUMS.md5
+"""
+
+
+def publish_package(runner, repository, package, category, artifact, info_dict):
+    """Copy a built package into the repository with its index fragments"""
+    required = ",".join(dep for dep in info_dict["REQUIRES"] if not dep.startswith("%"))
+    script = publish_template % {"repository": repository, "category": category, "package": package,
+                                 "artifact": artifact, "required": required}
+    runner.exec("sh -s", script.encode("utf-8"))
+
+
+def assemble_repository(backend, repository):
+    """Regenerate the repository index from the fragments left by publish_package()"""
+    print(f"Updating the repository index in {repository}")
+    backend.run("sh -s", (assemble_template % {"repository": repository}).encode("utf-8"))
+
+
 class Runner:
     """
         Run programs from the bot, doing something sensible with the output.
     """
-    def __init__(self, console, bot_index, donothing):
+    def __init__(self, console, bot_index, backend, status=None):
         self.console = console
         self.package = "<BOT>"
         self.bot_index = bot_index
-        self.donothing = donothing
+        self.backend = backend
+        self.status = status
+        self.step = "idle"
 
     def set_package(self, package):
         self.package = package
 
-    def echo(self, text):
-        self.console.put(((text+"\n").encode("utf-8"), self.package, self.bot_index))
-
-    def exec(self, command, stdin_text=None):
+    def set_step(self, step):
+        """Tell the status report what this bot is doing"""
+        self.step = step
+        if self.status:
+            self.status.set_bot(self.bot_index, None if step == "idle" else self.package, step)
 
-        command = get_remote_command(command)
-        if self.donothing:
-            if stdin_text:
-                self.echo(f'cat <script> | {command}')
-            else:
-                self.echo(f'{command}')
-        else:
-            self.run(command, stdin_text)
-
-    def run(self, command, stdin_text=None):
-        """"Execute a command from a bot thread"""
-
-        if stdin_text:
-            stdin_pipe = PIPE
-        else:
-            stdin_pipe = None
-
-        p = Popen(command, stdout=PIPE, stderr=PIPE, stdin=stdin_pipe, shell=True, bufsize=0)
-
-        # These threads only exist as long as the package build
-        sout = Thread(target=output_thread, args=(p.stdout, self.console, self.package, self.bot_index))
-        sout.daemon = True
-        sout.start()
-
-        serr = Thread(target=output_thread, args=(p.stderr, self.console, self.package, self.bot_index))
-        serr.daemon = True
-        serr.start()
-
-        if stdin_text:
-            p.stdin.write(stdin_text)
-            p.stdin.close()
-
-        sout.join()
-        serr.join()
-        p.wait()
-        if p.returncode != 0:
-            raise OSError("Error executing %r" % command)
+    def output(self, text):
+        self.console.put((text, self.package, self.bot_index))
 
-    def copytree(self, src_path, dest_path):
-        command = put_file_to_remote(src_path, dest_path)
-        if self.donothing:
-            self.echo(command)
-        else:
-            self.run(command)
+    def echo(self, text):
+        self.output((text+"\n").encode("utf-8"))
 
+    def exec(self, command, stdin_text=None, output=None):
+        """
+            Run command on the target, killing it if it breaks the timeouts of the current package and step.  The
+            output goes to output if given, which should pass it on to self.output.
+        """
+        timeout, idle = TIMEOUTS.limits(self.package, self.step)
+        self.backend.run(command, stdin_text, output or self.output, self.package, timeout, idle)
 
-def md5_sum(path):
-    """Get the checksum of the passed path or None if non-existent"""
-    rex = re.compile(r"^([a-f0-9]{32})\s+(\S+)$")
-    for line in remote_popen(f"md5sum {path}").split("\n"):
-        m = rex.match(line.strip())
-        if m:
-            return m.group(1)
-    return None
+    def query(self, command):
+        return self.backend.query(command)
 
 
 def required_source_files(info_dict):
@@ -543,14 +1453,20 @@ def required_source_files(info_dict):
     return zip(urls, files, checksums)
 
 
-def download_file_commands(info_dict, download_dir):
-    commands = []
+def missing_source_files(backend, info_dict, download_dir):
+    """(url, location) of the sources not already downloaded with the right checksum"""
+    missing = []
     for url, fname, checksum in required_source_files(info_dict):
         download_location = download_dir / fname
-        if md5_sum(download_location) != checksum:
-            command = "wget --no-check-certificate -O %s %s" % (download_location, url)
-            commands.append((command, download_location))
-    return commands
+        if backend.md5(download_location) != checksum:
+            missing.append((url, download_location))
+    return missing
+
+
+def download_command(url, location, rate=None):
+    if rate:
+        return "wget --no-check-certificate --limit-rate=%d -O %s %s" % (rate, location, url)
+    return "wget --no-check-certificate -O %s %s" % (location, url)
 
 
 class JobContext:
@@ -562,101 +1478,418 @@ class JobContext:
         pass
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type is None:
-            self.queue.put(self.package)
-        else:
-            self.queue.put(None)
+        if exc_type is not None:
+            # Report it and carry on, so a long-running engine doesn't lose the bot.
+            traceback.print_exception(exc_type, exc_val, exc_tb)
+        # Its memory is given back before the engine hears it's done, so what was held back can be tried again.
+        ADMISSION.release()
+        self.queue.put((self.package, exc_type is None))
+        return True
 
 
-def bot_thread(job_q, done_q, dep_manager, console, scripts, bot_index, args):
+def compose_build_script(package, dep_manager, scripts):
     """
-        download, build and install packages on job_q, push name to done_q when done.
+        Put together the script the bot actually runs: the before script, the requires scripts of the
+        dependencies, the SlackBuild and the after script.  Returns the script and a list of notes about what went
+        into it.
     """
-    runner = Runner(console, bot_index, args.donothing)
+    notes = []
+    src_path = dep_manager.get_source_location(package)
+
+    total_script = b'#!/bin/sh\n'
+    before = scripts.get_before(package)
+    if before:
+        notes.append('Adding *before* script for %s' % package)
+        total_script += before.open("rb").read()
+
+    for dep_package in dep_manager.resolve_dependencies([package], False):
+        if dep_package == package:
+            continue
+        requires = scripts.get_requires(dep_package)
+        if requires:
+            notes.append('Adding *requires* script for %s' % dep_package)
+            total_script += requires.open("rb").read()
+
+    notes.append('Adding *build* script %s' % (package + ".SlackBuild"))
+
+    build_script = src_path / (package + ".SlackBuild")
+    total_script += build_script.open("rb").read()
+
+    after = scripts.get_after(package)
+    if after:
+        notes.append('Adding *after* script for %s' % package)
+        total_script += after.open("rb").read()
+
+    return total_script, notes
+
+
+def stage_build_files(backend, dep_manager, scripts, packages, delta=True):
+    """
+        Send everything the bots need for packages, the SlackBuild directories and the composed build scripts, to
+        STAGING_DIR on the target as a single compressed tar stream.  With delta, directories and scripts the
+        target already has identical copies of aren't sent again.
+    """
+    staged = backend.checksums(STAGING_DIR) if delta else {}
+
+    def unchanged(prefix, files):
+        """files is {path in staging: contents}, all under prefix"""
+        return set(files) == {path for path in staged if path.startswith(prefix)} and \
+            all(staged.get(path) == hashlib.md5(data).hexdigest() for path, data in files.items())
+
+    changed = []
+    to_send = {}
+    modes = {}
+    for package in packages:
+        src_path = dep_manager.get_source_location(package)
+        prefix = f"slackbuilds/{src_path.parent.name}/{package}/"
+        paths = {prefix + str(path.relative_to(src_path)): path
+                 for path in sorted(src_path.rglob("*")) if path.is_file()}
+        files = {name: path.read_bytes() for name, path in paths.items()}
+        modes.update((name, stat.S_IMODE(path.stat().st_mode)) for name, path in paths.items())
+        if not unchanged(prefix, files):
+            changed.append(prefix.rstrip("/"))
+            to_send.update(files)
+
+        prefix = f"scripts/{package}.sh"
+        script = {prefix: compose_build_script(package, dep_manager, scripts)[0]}
+        if not unchanged(prefix, script):
+            to_send.update(script)
+
+    script = {PEAK_SCRIPT: peak_template.encode("utf-8")}
+    if not unchanged(PEAK_SCRIPT, script):
+        to_send.update(script)
+
+    if not to_send:
+        return
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for path, data in to_send.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            # Keep the executable bits of anything in the SlackBuild directories.
+            info.mode = modes.get(path, 0o644)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+
+    what = f"{len(changed)} SlackBuild directories and {len(to_send)} files ({len(buf.getvalue())} bytes)"
+    if backend.simulated:
+        print(f"Simulated, nothing sent: {what} would go to the target")
+    else:
+        print(f"Sending {what} to the target")
+    # Clear out changed directories first, so files removed from the SlackBuild don't linger.
+    backend.extract_tar(buf.getvalue(), STAGING_DIR, [STAGING_DIR / directory for directory in changed])
+
+
+# Runs the rest of its command line, writing to $1 the most memory (kB of RSS) in use at once by all the processes of
+# the session it runs in, sampled every second.  That's the whole build, a make -j included, not just its biggest
+# process.  Exits with the command's status.
+peak_template = """peak_file=$1
+shift
+session=$(ps -o sid= -p $$)
+(
+  peak=0
+  while :; do
+    rss=$(ps -o rss= -s $session | awk '{total += $1} END {print total + 0}')
+    if [ "$rss" -gt "$peak" ]; then
+      peak=$rss
+      echo $peak > "$peak_file"
+    fi
+    sleep 1
+  done
+) >/dev/null 2>&1 &
+sampler=$!
+"$@"
+status=$?
+kill $sampler
+exit $status
+"""
+PEAK_SCRIPT = "peak.sh"
+
+
+# Guess at the peak memory of a build that hasn't been measured yet
+DEFAULT_PEAK_MB = 512
+
+
+class AdmissionControl:
+    """
+        Decides whether the target has room to start another build.  A build is admitted if its peak memory (as
+        measured on earlier runs, see peak_mb in the stats) fits in the target's available memory less a reserve,
+        and the load average is under max_load.  The peaks of builds admitted but not yet finished are taken off
+        the available memory too, as they may not have got there yet.  When nothing else is building a job is
+        always admitted, so a package bigger than the target still gets its turn.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.running = {}
+        self.configure(0)
+
+    def configure(self, reserve_mb, max_load=None, peaks=None):
+        self.reserve_mb = reserve_mb
+        self.max_load = max_load
+        self.peaks = peaks or {}
+
+    def estimate(self, package):
+        return self.peaks.get(package, {}).get("peak_mb", DEFAULT_PEAK_MB)
+
+    @staticmethod
+    def target_state(backend):
+        """(available MB, 1 minute load average) on the target"""
+        available = None
+        load = 0.0
+        for line in backend.read_text("/proc/meminfo", "/proc/loadavg").split("\n"):
+            words = line.split()
+            if words and words[0] == "MemAvailable:":
+                available = int(words[1]) // 1024
+            elif len(words) == 5 and "/" in words[3]:
+                load = float(words[0])
+        return available, load
+
+    def admit(self, backend, package):
+        """Reserve room for package, or return a reason to hold it back"""
+        with self.lock:
+            name = current_thread().name
+            others = {thread: mb for thread, mb in self.running.items() if thread != name}
+            needed = self.estimate(package)
+            if others:
+                available, load = self.target_state(backend)
+                if available is not None:
+                    available -= self.reserve_mb + sum(others.values())
+                    if needed > available:
+                        return f"needs ~{needed}MB, {max(0, available)}MB to spare"
+                if self.max_load is not None and load >= self.max_load:
+                    return f"load average {load:.1f}"
+            self.running[name] = needed
+            return None
+
+    def release(self):
+        with self.lock:
+            self.running.pop(current_thread().name, None)
+
+    def snapshot(self):
+        """{thread name: MB reserved} of the builds admitted"""
+        with self.lock:
+            return dict(self.running)
+
+
+ADMISSION = AdmissionControl()
+
+
+class Reaper:
+    """
+        Deletes working directories in the background, so a bot doesn't wait on rm -rf of a big build tree.  The
+        directory is moved into REAP_DIR first, which is quick, so its name can be used again straight away.
+    """
+    def __init__(self):
+        self.queue = Queue()
+        self.lock = Lock()
+        self.thread = None
+        self.count = 0
+
+    def reap(self, backend, path):
+        with self.lock:
+            self.count += 1
+            doomed = REAP_DIR / ("%d_%d" % (time.time_ns(), self.count))
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name="reaper")
+                self.thread.daemon = True
+                self.thread.start()
+                # Anything left by an earlier run that didn't get to finish.
+                self.queue.put((backend, REAP_DIR / "*"))
+        backend.move(path, doomed)
+        self.queue.put((backend, doomed))
+
+    def run(self):
+        while True:
+            backend, path = self.queue.get(True)
+            backend.remove_tree(path)
+            self.queue.task_done()
+
+    def wait(self):
+        """Block until everything handed over so far is gone"""
+        self.queue.join()
+
+
+REAPER = Reaper()
+
+
+class PackagingTimer:
+    """
+        Passes build output on to output, timing makepkg from its banner to its 'created' line, so the time spent
+        compressing the package can be told apart from the rest of the build.
+    """
+    def __init__(self, output):
+        self.output = output
+        self.start = None
+        self.seconds = 0.0
+
+    def __call__(self, text):
+        if text.startswith(b"Slackware package maker"):
+            self.start = time.time()
+        elif self.start is not None and text.startswith(b"Slackware package ") and text.rstrip().endswith(b"created."):
+            self.seconds += time.time() - self.start
+            self.start = None
+        self.output(text)
+
+
+def packaging_environment(args):
+    """The variables that set the format of the package each SlackBuild makes, if asked"""
+    env = []
+    if args.pkgtype:
+        env.append(f"PKGTYPE={args.pkgtype}")
+    return env
+
+
+def record_timing(backend, package, step, seconds):
+    """Record how long a step took, unless it was only simulated"""
+    if not backend.simulated:
+        record_stat(package, step, seconds)
+
+
+def bot_thread(job_q, done_q, dep_manager, console, scripts, bot_index, args, backend, status, journal):
+    """
+        download, build and install packages on job_q, push (name, succeeded) to done_q when done, or (name, None)
+        if there isn't room on the target to build it yet.
+    """
+    runner = Runner(console, bot_index, backend, status)
 
     bot_working_dir = BOT_WORKING_DIRS / ("%02d" % bot_index)
-    runner.exec("rm -rf %s" % bot_working_dir)
-    runner.exec("mkdir -p %s" % bot_working_dir)
+    REAPER.reap(backend, bot_working_dir)
+    backend.make_dirs(bot_working_dir, output=runner.output)
 
     job_count = 0
-    download_lock = DOWNLOAD_LOCK if args.getinparallel else NoOpLock()
 
     package = True
     while package:
+        runner.set_step("idle")
+        ADMISSION.release()
         package = job_q.get(True)
         if package is None:
             return
 
+        # Journal entries for another version, left by a run before the tree was synced, don't count.
+        version = dep_manager.get_version(package)
+
+        if not args.onlydownload and not journal.done(package, "built", version=version):
+            reason = ADMISSION.admit(backend, package)
+            if reason:
+                # The engine hands it out again when a build finishes and there might be room.
+                runner.set_package(package)
+                runner.echo(f"Holding back {package}: {reason}")
+                done_q.put((package, None))
+                continue
+
         with JobContext(done_q, package):
             runner.set_package(package)
+            runner.set_step("prepare")
             job_count += 1
 
             working_dir = bot_working_dir / ("%03x_%s" % (job_count, package))
 
-            src_path = dep_manager.get_source_location(package)
-            info = src_path / (package + ".info")
+            info = dep_manager.get_source_location(package) / (package + ".info")
 
             if args.pipinstall:
                 # Have a go at installing with pip.  If we can't still try to let SBo do it
                 if dep_manager.is_python_package(package):
                     pypi = dep_manager.sbo_to_pypi(package)
                     pip_ver = dep_manager.get_pip_version(package)
+                    runner.set_step("pip")
                     with INSTALLER_LOCK:
                         runner.exec('%s install %s' % (pip_ver, pypi))
+                    journal.record(package, "installed", version=version)
                     continue
 
-            runner.exec("rm -rf %s" % working_dir)
-            runner.copytree(src_path, working_dir)
-
-            # Download step
             info_dict = read_info(info)
-            category = dep_manager.get_source_location(package).parent.name
-            download_dir = DOWNLOAD_PKG_DIR / category / package
-            for command, location in download_file_commands(info_dict, download_dir):
-                runner.exec("mkdir -p %s" % download_dir)
-                with download_lock:
-                    runner.exec(command)
-                    
-            for url, file_name, checksum in required_source_files(info_dict):
-                runner.exec("cp %s %s" % (download_dir / file_name, working_dir / file_name))
-
-            if args.onlydownload:
-                continue
 
-            temp_wrapper = working_dir / "afterpkg-build.sh"
+            # A package built before an interrupted run only needs installing, if it's still there.
+            built_location = journal.artifact(package, version=version)
+            if built_location and not backend.exists(built_location):
+                built_location = None
 
-            total_script = b'#!/bin/sh\n'
-            before = scripts.get_before(package)
-            if before:
-                runner.echo('Adding *before* script for %s' % package)
-                total_script += before.open("rb").read()
-
-            for dep_package in dep_manager.resolve_dependencies([package], False):
-                if dep_package == package:
+            if built_location:
+                runner.echo('Already built as %s' % built_location)
+            else:
+                # The SlackBuild directory and the build script were sent to the target by stage_build_files()
+                temp_wrapper = working_dir / "afterpkg-build.sh"
+                category = dep_manager.get_source_location(package).parent.name
+                backend.copy_tree(STAGING_DIR / 'slackbuilds' / category / package, working_dir, output=runner.output)
+                backend.copy_file(STAGING_DIR / 'scripts' / (package + '.sh'), temp_wrapper, output=runner.output)
+
+                # Download step
+                download_dir = DOWNLOAD_PKG_DIR / category / package
+                sources = list(required_source_files(info_dict))
+                checksums = [checksum for url, file_name, checksum in sources]
+                downloaded = journal.done(package, "downloaded", version=version, md5=checksums) and \
+                    all(backend.exists(download_dir / file_name) for url, file_name, checksum in sources)
+                if not downloaded:
+                    runner.set_step("download")
+                    download_time = 0.0
+                    for url, location in missing_source_files(backend, info_dict, download_dir):
+                        backend.make_dirs(download_dir, output=runner.output)
+                        host = urlparse(url).hostname or "unknown"
+                        rate = DOWNLOADS.acquire(host)
+                        try:
+                            start = time.time()
+                            runner.exec(download_command(url, location, rate))
+                            elapsed = time.time() - start
+                        finally:
+                            DOWNLOADS.release(host)
+                        download_time += elapsed
+                        if not backend.simulated:
+                            record_host_throughput(host, backend.file_size(location), elapsed)
+                    if download_time:
+                        record_timing(backend, package, "download", download_time)
+                    journal.record(package, "downloaded", version=version, md5=checksums)
+
+                backend.link_files([(download_dir / file_name, working_dir / file_name)
+                                    for url, file_name, checksum in sources],
+                                   output=runner.output)
+
+                if args.onlydownload:
+                    REAPER.reap(backend, working_dir)
                     continue
-                requires = scripts.get_requires(dep_package)
-                if requires:
-                    runner.echo('Adding *requires* script for %s' % dep_package)
-                    total_script += requires.open("rb").read()
-
-            runner.echo('Adding *build* script %s' % (package + ".SlackBuild"))
-
-            build_script = src_path / (package + ".SlackBuild")
-            total_script += build_script.open("rb").read()
-
-            after = scripts.get_after(package)
-            if after:
-                runner.echo('Adding *after* script for %s' % package)
-                total_script += after.open("rb").read()
-
-            runner.exec(f"dd of={temp_wrapper}", total_script)
-            runner.exec(f"cd {working_dir} && sh {temp_wrapper}")
 
+                for note in compose_build_script(package, dep_manager, scripts)[1]:
+                    runner.echo(note)
+
+                runner.set_step("build")
+                # The build gets its own TMP, and an OUTPUT of its own outside the working directory so the package
+                # outlives it.  Whatever is in OUTPUT afterwards is what was built.
+                tmp_dir = working_dir / "tmp"
+                output_dir = OUTPUT_DIRS / package
+                REAPER.reap(backend, output_dir)
+                backend.make_dirs(tmp_dir, output_dir, output=runner.output)
+                start = time.time()
+                peak_file = working_dir / "afterpkg-peak"
+                env = " ".join([f"TMP={tmp_dir}", f"OUTPUT={output_dir}"] + packaging_environment(args))
+                packaging = PackagingTimer(runner.output)
+                runner.exec(f"cd {working_dir} && {env} sh {STAGING_DIR / PEAK_SCRIPT} {peak_file} sh {temp_wrapper}",
+                            output=packaging)
+                record_timing(backend, package, "build", time.time() - start)
+                if packaging.seconds:
+                    runner.echo("Packaging took %.1fs" % packaging.seconds)
+                    record_timing(backend, package, "package", packaging.seconds)
+                peak_kb = backend.read_text(peak_file).strip().split("\n")[-1]
+                if peak_kb.isdigit() and not backend.simulated:
+                    record_stat(package, "peak_mb", int(peak_kb) // 1024)
+
+                built_location = get_built_package_location(backend, package, info_dict, output_dir)
+                journal.record(package, "built", version=version, artifact=str(built_location))
+
+            runner.set_step("install")
             with INSTALLER_LOCK:
-                built_location = "/tmp/%s-%s-...tgz" % (package, info_dict["VERSION"])
-                if not args.donothing:
-                    built_location = get_built_package_location(package, info_dict)
+                start = time.time()
                 runner.exec("installpkg %s" % str(built_location))
+                record_timing(backend, package, "install", time.time() - start)
+            journal.record(package, "installed", version=version)
+
+            # Only once it's known to install, other hosts will be installing it from here.
+            if args.repository:
+                runner.set_step("publish")
+                category = dep_manager.get_source_location(package).parent.name
+                publish_package(runner, args.repository, package, category, built_location, info_dict)
+            # Left behind if anything went wrong, to see why.
+            REAPER.reap(backend, working_dir)
 
 
 COLOURS = {
@@ -671,8 +1904,8 @@ COLOURS = {
 REVERT_COLOUR = '\x1b[0m'
 
 
-def console_thread(console_q, args):
-    """read console_q, write => stdout"""
+def console_thread(console_q, args, listeners=()):
+    """read console_q, write => stdout, and pass (text, package) to each of listeners"""
     if args.nocolour:
         colour, revert_colour = [""]*6, ""
     else:
@@ -689,15 +1922,20 @@ def console_thread(console_q, args):
             prefix = f"[{bot_index}]:{package}: "
 
         sys.stdout.write(colour[bot_index % 6] + prefix + text.decode("utf-8") + revert_colour)
+        for listener in list(listeners):
+            listener(text, package)
 
 
-def bot_controller_thread(job_q, done_q, console_q, dep_manager, scripts, args):
+def bot_controller_thread(job_q, done_q, console_q, dep_manager, scripts, args, backend, status, journal,
+                          bot_target=bot_thread):
     """Fire up a thread per build bot"""        
     bot_threads = []
 
     int(args.numthreads)
     for bot_index in range(int(args.numthreads)):
-        bot = Thread(target=bot_thread, args=(job_q, done_q, dep_manager, console_q, scripts, bot_index, args))
+        bot = Thread(target=bot_target, name="bot-%02d" % bot_index,
+                     args=(job_q, done_q, dep_manager, console_q, scripts, bot_index, args, backend, status,
+                           journal))
         bot.daemon = True
         bot.start()
         bot_threads.append(bot)
@@ -706,74 +1944,704 @@ def bot_controller_thread(job_q, done_q, console_q, dep_manager, scripts, args):
         thread.join()
 
 
-def write_bot_status(ident, value):
-    bot_status = BOT_STATUS_DIR / f"{ident}.txt"
-    bot_data = "\n".join(value) + "\n"
-    bot_status.open("wb").write(bot_data.encode("utf-8"))
+class Journal:
+    """
+        Append-only record of the steps each package has finished, one JSON object per line, so an interrupted
+        run can be resumed.  A run that isn't resuming starts a new journal.  If readonly (for simulated runs) the
+        journal is read but nothing gets written.
+    """
+    def __init__(self, path, resume, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.lock = Lock()
+        self.steps = {}
+        if resume and path.exists():
+            for line in path.open("r"):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue    # Probably the line being written when we died.
+                if entry["step"] == "forgotten":
+                    self.steps.pop(entry["package"], None)
+                else:
+                    self.steps.setdefault(entry["package"], {})[entry["step"]] = entry
+        elif not readonly:
+            path.write_text("")
+
+    def done(self, package, step, **fields):
+        """Whether package got through step, with the same fields (e.g. version) as given"""
+        entry = self.steps.get(package, {}).get(step)
+        return entry is not None and all(entry.get(name) == value for name, value in fields.items())
+
+    def artifact(self, package, **fields):
+        """Where the package was built, or None.  fields are checked as for done()"""
+        if self.done(package, "built", **fields):
+            return self.steps[package]["built"].get("artifact")
+        return None
+
+    def forget(self, package):
+        """Start package over, e.g. when it's been removed since it was installed"""
+        self.record(package, "forgotten")
+
+    def record(self, package, step, **fields):
+        entry = dict(time=time.time(), package=package, step=step, **fields)
+        with self.lock:
+            if step == "forgotten":
+                self.steps.pop(package, None)
+            else:
+                self.steps.setdefault(package, {})[step] = entry
+            if self.readonly:
+                return
+            with self.path.open("a") as fp:
+                fp.write(json.dumps(entry) + "\n")
+                fp.flush()
+                os.fsync(fp.fileno())
 
 
-def start_build_engine(dep_manager, packages, scripts, args):
-    """packages is the list of packages to build"""
+class BuildStatus:
+    """
+        What the build engine is up to, updated by the scheduler and the bots and served as JSON to anything that
+        asks, see serve_status().
+    """
+    def __init__(self, numthreads, durations):
+        self.lock = Lock()
+        self.started = time.time()
+        self.numthreads = numthreads
+        self.durations = durations
+        self.bots = {}
+        self.pending = []
+        self.queued = []
+        self.built = set()
+        for bot_index in range(numthreads):
+            self.set_bot(bot_index, None, "idle")
+
+    def set_bot(self, bot_index, package, step):
+        with self.lock:
+            self.bots[bot_index] = (package, step, time.time())
+
+    def set_queue(self, pending, queued, built):
+        with self.lock:
+            self.pending = list(pending)
+            self.queued = list(queued)
+            self.built = set(built)
+
+    def eta(self, now):
+        """Seconds of estimated work left, spread over the bots"""
+        running = {package: since for package, step, since in self.bots.values() if package}
+        remaining = 0.0
+        for package in self.pending + self.queued:
+            if package not in running and package not in self.built:
+                remaining += self.durations.get(package, DEFAULT_PACKAGE_SECONDS)
+        for package, since in running.items():
+            remaining += max(0.0, self.durations.get(package, DEFAULT_PACKAGE_SECONDS) - (now - since))
+        return remaining / self.numthreads
+
+    def snapshot(self):
+        """pending packages wait on dependencies, queued ones are ready and waiting for a free bot"""
+        now = time.time()
+        with self.lock:
+            running = {package for package, step, since in self.bots.values()}
+            return {
+                "elapsed": now - self.started,
+                "eta": self.eta(now),
+                "pending": len(self.pending),
+                "queued": len([package for package in self.queued
+                               if package not in self.built and package not in running]),
+                "running": len(running - {None}),
+                "built": len(self.built),
+                "bots": [{"bot": bot_index, "package": package, "step": step, "elapsed": now - since}
+                         for bot_index, (package, step, since) in sorted(self.bots.items())],
+                "locks": {"installer": INSTALLER_LOCK.holder},
+                "downloads": DOWNLOADS.snapshot(),
+                "memory": ADMISSION.snapshot(),
+            }
+
+
+STATUS_POLL_SECONDS = 0.05
+
+
+def status_socket(args):
+    """The status socket of a run, one per target so runs building on different hosts don't clash"""
+    host = getattr(args, "targethost", None)
+    if host:
+        return STATUS_SOCKET.with_name(f"status-{host}.sock")
+    return STATUS_SOCKET
+
+
+def serve_status(status, path, port=None):
+    """
+        Serve status.snapshot() as JSON on the Unix socket path, and on http://localhost:port/ if a port is given.
+        Returns the servers so they can be shut down.  Raises OSError if another run is serving on path.
+    """
+    class StreamHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            self.wfile.write(json.dumps(status.snapshot()).encode("utf-8") + b"\n")
+
+    class HTTPHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(status.snapshot()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    if path.exists():
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(str(path))
+        except OSError:
+            # Left behind by a run that died.
+            path.unlink(missing_ok=True)
+        else:
+            raise OSError(f"Another {PROGNAME} run is already building for this target, see {path}")
+        finally:
+            probe.close()
+    servers = [socketserver.ThreadingUnixStreamServer(str(path), StreamHandler)]
+    if port:
+        servers.append(ThreadingHTTPServer(("127.0.0.1", int(port)), HTTPHandler))
+    for server in servers:
+        server.daemon_threads = True
+        # A short poll so shutting down doesn't hold up the end of the run.
+        thread = Thread(target=server.serve_forever, kwargs={"poll_interval": STATUS_POLL_SECONDS})
+        thread.daemon = True
+        thread.start()
+    return servers
+
+
+def stop_serving_status(servers):
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    if servers:
+        Path(servers[0].server_address).unlink(missing_ok=True)
+
+
+def engine_backend(args):
+    """The backend the bots use.  With -d nothing is run, the commands are shown against a model of the target."""
+    if args.donothing:
+        return SimulatedBackend(shown=g_backend)
+    return g_backend
+
+
+class BuildEngine:
+    """
+        The bots and the scheduling of their work.  Packages handed to build() are queued for the bots as their
+        dependencies get built.  build() can be called from several threads at once (the daemon does this), they
+        share the bots and a package asked for twice at once is only built once.  A package asked for again after
+        it was built is built again, as the resolver only asks for packages it doesn't see installed.  Whatever
+        finished in an interrupted run counts as built already.  bot_target is the function each bot thread runs.
+    """
+    def __init__(self, dep_manager, scripts, args, backend=None, bot_target=bot_thread):
+        if backend is None:
+            backend = g_backend
+        self.dep_manager = dep_manager
+        self.args = args
+        self.numthreads = int(args.numthreads)
+
+        # Claimed first, so a second run for the same target stops before it touches anything.  With -d nothing
+        # is built, so there's nothing to report on and no reason to stop another run being started.
+        self.status = BuildStatus(self.numthreads, {})
+        self.status_servers = []
+        if not args.donothing:
+            self.status_servers = serve_status(self.status, status_socket(args),
+                                               getattr(args, "statusport", None))
+
+        self.journal = Journal(JOURNAL_FILE, args.resume, backend.simulated)
+        if not args.resume:
+            REAPER.reap(backend, BOT_WORKING_DIRS)
+        self.last_step = "downloaded" if args.onlydownload else "installed"
+
+        self.job_q = Queue()
+        self.done_q = Queue()
+        self.console_q = Queue()
+        self.listeners = []
+
+        # To avoid all the bots chopping each other's output, this thread syncs and colourises it.
+        self.console_controller = Thread(target=console_thread, args=(self.console_q, args, self.listeners))
+        self.console_controller.daemon = True
+        self.console_controller.start()
+
+        # This thread controls the bots.
+        self.bot_controller = Thread(target=bot_controller_thread,
+                                     args=(self.job_q, self.done_q, self.console_q, dep_manager, scripts, args,
+                                           backend, self.status, self.journal, bot_target))
+        self.bot_controller.daemon = True
+        self.bot_controller.start()
+
+        self.cond = Condition()
+        self.built = set()
+        self.failed = set()
+        self.pending = []
+        self.queued = []
+        self.held = []
+
+        # This one collects finished packages from the bots.
+        self.collector = Thread(target=self.collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def dispatch(self):
+        """Queue the pending packages with no (un-built) dependencies, fail those whose dependencies failed"""
+        ready = []
+        for package in self.pending:
+            deps = set(self.dep_manager.lookup_deps(package) or [])
+            if deps & self.failed:
+                self.failed.add(package)
+            elif not deps - self.built:
+                self.job_q.put(package)
+                ready.append(package)
+        self.pending = [i for i in self.pending if i not in ready and i not in self.failed]
+        self.queued = [i for i in self.queued if i not in self.built and i not in self.failed] + ready
+        self.status.set_queue(self.pending, self.queued, self.built)
+
+    def collect(self):
+        while True:
+            package, ok = self.done_q.get(True)
+            with self.cond:
+                if ok is None:
+                    self.held.append(package)
+                    # Builds give back their memory before they report in, so if none has any the builds that
+                    # held this one back have all been collected already.
+                    if ADMISSION.snapshot():
+                        continue
+                elif ok:
+                    self.built.add(package)
+                else:
+                    self.failed.add(package)
+                # Something finished, so there may be room for what was held back.
+                for held in self.held:
+                    self.job_q.put(held)
+                self.held = []
+                self.dispatch()
+                self.cond.notify_all()
+
+    def build(self, packages):
+        """
+            Build packages, as resolved by the DependencyManager, and wait for them.  A failure only stops the
+            packages that depend on it, everything else is still built.  Returns the packages that failed or were
+            skipped for it, once there's nothing left to build.
+        """
+        with self.cond:
+            self.status.durations.update(estimate_durations(packages, sizes={}))
+            for package in packages:
+                if package in self.pending or package in self.queued:
+                    continue
+                if package in self.built:
+                    # Removed since, or a new version after the tree was refreshed.
+                    self.built.discard(package)
+                    self.journal.forget(package)
+                elif self.journal.done(package, self.last_step, version=self.dep_manager.get_version(package)):
+                    self.built.add(package)
+                    continue
+                # Asking again is how a failed package gets another go.
+                self.failed.discard(package)
+                self.pending.append(package)
+            self.dispatch()
 
-    remote_popen("rm -rf %s" % BOT_WORKING_DIRS)
+            while not all(package in self.built or package in self.failed for package in packages):
+                self.cond.wait()
+            return [package for package in packages if package in self.failed]
 
-    job_q = Queue()
-    done_q = Queue()
-    console_q = Queue()
+    def shutdown(self, wait=True):
+        """Stop the bots, if wait let them finish what they're doing first"""
+        stop_serving_status(self.status_servers)
 
-    # To avoid all the bots chopping each other's output, this thread syncs and colourises it.
-    console_controller = Thread(target=console_thread, args=(console_q, args))
-    console_controller.daemon = True
-    console_controller.start()
+        # Signal the bots to drop out of their job processing loops.
+        for _ in range(self.numthreads):
+            self.job_q.put(None)
 
-    # This thread controls the bots.
-    bot_controller = Thread(target=bot_controller_thread, args=(job_q, done_q, console_q, dep_manager, scripts, args))
-    bot_controller.daemon = True
-    bot_controller.start()
+        if not wait:
+            return
 
-    pending = copy.copy(packages)
-    built = set()
+        # The controller will quit when the bots quit
+        self.bot_controller.join()
 
-    has_error = False
+        # Tell the console thread we're done with it otherwise it'll wait forever for more input
+        self.console_q.put((None, None, None))
 
-    while pending:
-        # Figure out the set of packages that we can queue.  These will be the ones with no (un-built) dependencies.
-        queued = []
-        for package in pending:
-            if set(dep_manager.lookup_deps(package)) - built:
-                continue
-            job_q.put(package)
-            queued.append(package)
-            
-        pending = [i for i in pending if i not in queued]
-        write_bot_status("pending", pending)
-        write_bot_status("built", built)
-
-        # Wait for a package to get built, then re-assess which packages are ready.
-        done = done_q.get(True)
-        if done is None:
-            print("There was an error, shutting down...")
-            has_error = True
-            break
+        # Wait for any remaining console output to flush before continuing.
+        self.console_controller.join()
 
-        built.add(done)
+        REAPER.wait()
 
-    # Signal the bots to drop out of their job processing loops.
-    for _ in range(int(args.numthreads)):
-        job_q.put(None)
 
-    if has_error:
-        time.sleep(0.5)  # Hopefully enough time for the exception to get printed.
+def start_build_engine(dep_manager, packages, scripts, args, backend=None, bot_target=bot_thread, delta=None):
+    """
+        packages is the list of packages to build.  Their files are staged on the target once the engine has
+        claimed it, if delta is given (see stage_build_files()), otherwise they should be there already.
+        bot_target is the function each bot thread runs.
+    """
+    try:
+        engine = BuildEngine(dep_manager, scripts, args, backend, bot_target)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if delta is not None:
+        stage_build_files(backend or g_backend, dep_manager, scripts, packages, delta)
+    failed = engine.build(packages)
+    engine.shutdown()
+    if failed:
+        print("Not built, failed or a dependency failed: %s" % " ".join(failed), file=sys.stderr)
         sys.exit(1)
 
-    # The controller will quit when the bots quit
-    bot_controller.join()
 
-    # Tell the console thread we're done with it otherwise it'll wait forever for more input
-    console_q.put((None, None, None))
+def tree_signature(path):
+    """
+        The modification times of the category and package directories of a SlackBuilds tree.  These change when
+        packages come and go, or when files in them are replaced (by a sync, git or most editors).
+    """
+    out = []
+    for category in path.iterdir():
+        if category.is_dir() and not category.name.startswith("."):
+            out.append((category.name, category.stat().st_mtime_ns))
+            out.extend((package.name, package.stat().st_mtime_ns) for package in category.iterdir())
+    return sorted(out)
 
-    # Wait for any remaining console output to flush before continuing.
-    console_controller.join()
+
+class Daemon:
+    """
+        Keeps the DependencyManager (and the pypi list and inventory behind it) warm between requests, and runs
+        one BuildEngine whose bots are shared by all the build requests.  A request is a line of JSON,
+        {"command": "resolve"|"queue"|"build", "packages": [...]}, and the replies are lines of JSON too.  resolve
+        gives every package needed, installed or not, queue what would be built.  build streams the output of
+        the bots building the queue as {"output": text} and ends with {"failed": [packages]}.  The tree is
+        rescanned when it changes, and the installed and pip package lists fetched again when packages are
+        installed or removed, by the daemon or anything else.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.path = Path(args.slackbuilds)
+        self.lock = Lock()
+        self.stage_lock = Lock()
+        self.dep_manager = DependencyManager(self.path, args.novirtual, None, args.nopip2, args.nopip3)
+        self.signature = tree_signature(self.path)
+        self.installed = g_backend.list_dir(INSTALLED_PACKAGES_DIR)
+        self.scripts = ScriptManager(find_scripts_location(), args)
+        self.backend = engine_backend(args)
+        self.engine = None
+
+    def refresh(self):
+        with self.lock:
+            signature = tree_signature(self.path)
+            if signature != self.signature:
+                print("Slackbuild directory changed, rescanning")
+                g_info_cache.clear()
+                self.dep_manager.scan(self.path)
+                self.signature = signature
+            installed = g_backend.list_dir(INSTALLED_PACKAGES_DIR)
+            if installed != self.installed:
+                self.dep_manager.inventory.forget("slack_pkg_local", "pypi_local_py2", "pypi_local_py3")
+                self.installed = installed
+
+    def handle(self, request, reply):
+        self.refresh()
+        packages = request.get("packages", [])
+        command = request.get("command")
+        unknown = [package for package in packages if not self.dep_manager.is_sbo_pkg(package)]
+        if unknown:
+            reply({"error": "Package(s) not found: %s" % " ".join(unknown)})
+        elif command == "resolve":
+            reply({"packages": self.dep_manager.resolve_dependencies(packages, False)})
+        elif command == "queue":
+            reply({"packages": self.dep_manager.resolve_dependencies(packages, True)})
+        elif command == "build":
+            self.build(packages, reply)
+        else:
+            reply({"error": f"Unknown command {command!r}"})
+
+    def build(self, packages, reply):
+        resolved = self.dep_manager.resolve_dependencies(packages, True)
+        with self.lock:
+            if self.engine is None:
+                try:
+                    self.engine = BuildEngine(self.dep_manager, self.scripts, self.args, self.backend)
+                except OSError as e:
+                    reply({"error": str(e)})
+                    return
+        with self.stage_lock:
+            stage_build_files(self.backend, self.dep_manager, self.scripts, resolved, not self.args.fulltransfer)
+
+        wanted = set(resolved)
+
+        def listener(text, package):
+            if package in wanted:
+                reply({"output": f"{package}: " + text.decode("utf-8", "replace")})
+
+        self.engine.listeners.append(listener)
+        try:
+            failed = self.engine.build(resolved)
+        finally:
+            self.engine.listeners.remove(listener)
+        # What's installed has changed.
+        self.dep_manager.inventory.forget("slack_pkg_local", "pypi_local_py2", "pypi_local_py3")
+        reply({"failed": failed})
+
+    def serve(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                lock = Lock()
+
+                def reply(message):
+                    with lock:
+                        try:
+                            self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+                            self.wfile.flush()
+                        except OSError:
+                            pass  # The client went away, the build carries on.
+
+                line = self.rfile.readline()
+                if line:
+                    daemon.handle(json.loads(line), reply)
+
+        DAEMON_SOCKET.unlink(missing_ok=True)
+        server = socketserver.ThreadingUnixStreamServer(str(DAEMON_SOCKET), Handler)
+        server.daemon_threads = True
+        print(f"Waiting for requests on {DAEMON_SOCKET}")
+        # Clean up on kill as well as Ctrl-C.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            DAEMON_SOCKET.unlink(missing_ok=True)
+            if self.engine:
+                self.engine.shutdown(wait=False)
+
+
+def daemon_request(request):
+    """Send a request to the daemon, print any build output, return the last reply"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(DAEMON_SOCKET))
+    except OSError:
+        print(f"No {PROGNAME} daemon listening on {DAEMON_SOCKET}, start one with -D", file=sys.stderr)
+        sys.exit(1)
+    with sock, sock.makefile("rwb") as fp:
+        fp.write(json.dumps(request).encode("utf-8") + b"\n")
+        fp.flush()
+        reply = {}
+        for line in fp:
+            reply = json.loads(line)
+            if "output" in reply:
+                sys.stdout.write(reply["output"])
+        return reply
+
+
+# Used to guess how long a package takes when it's never been built before.
+DEFAULT_PACKAGE_SECONDS = 120
+SOURCE_BYTES_PER_SECOND = 100000
+
+
+def source_sizes():
+    """Sizes of the downloaded sources on the target, {package: bytes}"""
+    sizes = {}
+    for line in remote_popen(f"du -sb {DOWNLOAD_PKG_DIR}/*/*").split("\n"):
+        size, _, path = line.partition("\t")
+        if size.isdigit():
+            sizes[Path(path).name] = int(size)
+    return sizes
+
+
+def estimate_durations(packages, sizes=None):
+    """
+        How long each package will take to download, build and install, {package: seconds}.  Uses the timings of
+        earlier runs, or failing that a guess based on the size of already downloaded sources (as given in sizes,
+        or fetched from the target).
+    """
+    stats = load_stats()
+    if sizes is None:
+        sizes = source_sizes()
+    durations = {}
+    for package in packages:
+        steps = stats.get(package, {})
+        if "build" in steps:
+            durations[package] = sum(steps.get(step, 0.0) for step in ["download", "build", "install"])
+        elif package in sizes:
+            durations[package] = max(1.0, sizes[package] / SOURCE_BYTES_PER_SECOND)
+        else:
+            durations[package] = DEFAULT_PACKAGE_SECONDS
+    return durations
+
+
+def dependency_graph(dep_manager, packages):
+    """{package: [deps]} restricted to the packages being built"""
+    wanted = set(packages)
+    return {package: [dep for dep in dep_manager.lookup_deps(package) if dep in wanted] for package in packages}
+
+
+def critical_path(packages, graph, durations):
+    """
+        The longest chain of dependent builds, as (seconds, [packages]).  packages must be in resolved order, that
+        is every package comes after its dependencies.
+    """
+    finish = {}
+    previous = {}
+    for package in packages:
+        start = 0.0
+        for dep in graph[package]:
+            if finish[dep] > start:
+                start = finish[dep]
+                previous[package] = dep
+        finish[package] = start + durations[package]
+    if not finish:
+        return 0.0, []
+    last = max(finish, key=finish.get)
+    path = [last]
+    while path[-1] in previous:
+        path.append(previous[path[-1]])
+    return finish[last], path[::-1]
+
+
+def simulate_schedule(packages, graph, durations, numthreads):
+    """
+        Replay the start_build_engine scheduling policy with numthreads bots: whenever a build finishes, queue every
+        pending package whose dependencies are built, in queue order, and hand queued jobs to free bots first come
+        first served.  Return (makespan, busy) where busy is the total bot time spent building.
+    """
+    pending = list(packages)
+    built = set()
+    job_q = []
+    running = []    # (finish time, package)
+    now = 0.0
+    busy = 0.0
+    while pending or job_q or running:
+        queued = [package for package in pending if not set(graph[package]) - built]
+        job_q.extend(queued)
+        pending = [package for package in pending if package not in queued]
+
+        while job_q and len(running) < numthreads:
+            package = job_q.pop(0)
+            running.append((now + durations[package], package))
+            busy += durations[package]
+
+        if not running:
+            break   # Nothing can make progress, the remaining packages have unsatisfiable dependencies.
+        running.sort()
+        now, done = running.pop(0)
+        built.add(done)
+    return now, busy
+
+
+def format_seconds(seconds):
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def print_schedule_prediction(dep_manager, packages, max_threads):
+    """Predict the wall time of building packages for 1..max_threads bots"""
+    graph = dependency_graph(dep_manager, packages)
+    durations = estimate_durations(packages)
+    total = sum(durations.values())
+    length, path = critical_path(packages, graph, durations)
+
+    print(f"{len(packages)} packages, {format_seconds(total)} of work")
+    print(f"Critical path {format_seconds(length)}: " + " -> ".join(path))
+    print("threads  makespan  utilisation")
+    for numthreads in range(1, max_threads + 1):
+        makespan, busy = simulate_schedule(packages, graph, durations, numthreads)
+        utilisation = busy / (numthreads * makespan) if makespan else 0.0
+        print("%7d  %8s  %10.0f%%" % (numthreads, format_seconds(makespan), 100.0 * utilisation))
+
+
+def analyse_graph(packages, graph, durations):
+    """
+        Work out the shape of the dependency graph of the queue: each package's level (0 for no dependencies,
+        otherwise one more than its deepest dependency), how many packages there are at each level, the critical
+        path, and when each package would start and finish given as many bots as could be used.  From that comes
+        the most bots the engine could keep busy at once, and the packages that would build with nothing else
+        running: these serialise the build, no number of threads helps while they run.
+    """
+    levels = {}
+    start = {}
+    finish = {}
+    for package in packages:
+        levels[package] = max([levels[dep] + 1 for dep in graph[package]], default=0)
+        start[package] = max([finish[dep] for dep in graph[package]], default=0.0)
+        finish[package] = start[package] + durations[package]
+
+    by_level = [[] for _ in range(max(levels.values(), default=-1) + 1)]
+    for package in packages:
+        by_level[levels[package]].append(package)
+
+    # Sweep through the starts and finishes, finishes first when they coincide.
+    events = sorted([(finish[package], -1, package) for package in packages] +
+                    [(start[package], 1, package) for package in packages])
+    running = set()
+    shared = set()
+    max_parallelism = 0
+    for _, change, package in events:
+        if change < 0:
+            running.discard(package)
+            continue
+        if running:
+            shared.add(package)
+            shared.update(running)
+        running.add(package)
+        max_parallelism = max(max_parallelism, len(running))
+    serial = [package for package in packages if package not in shared and finish[package] > start[package]]
+
+    length, path = critical_path(packages, graph, durations)
+    total = sum(durations.values())
+    return {
+        "packages": {package: {"deps": graph[package], "level": levels[package], "seconds": durations[package],
+                               "start": start[package], "finish": finish[package]} for package in packages},
+        "levels": by_level,
+        "width": [len(level) for level in by_level],
+        "critical_path": {"seconds": length, "packages": path},
+        "total_seconds": total,
+        "max_parallelism": max_parallelism,
+        "average_parallelism": total / length if length else 0.0,
+        "serial": serial,
+    }
+
+
+def graph_to_dot(analysis):
+    """The analysed graph in graphviz format, a rank per level, the critical path in red, serialising packages filled"""
+    critical = analysis["critical_path"]["packages"]
+    critical_edges = set(zip(critical, critical[1:]))
+    lines = ["digraph %s {" % PROGNAME, "    rankdir=LR;", "    node [shape=box];"]
+    for package, node in analysis["packages"].items():
+        attrs = ['label="%s\\n%s"' % (package, format_seconds(node["seconds"]))]
+        if package in critical:
+            attrs.append("color=red")
+        if package in analysis["serial"]:
+            attrs.append("style=filled fillcolor=orange")
+        lines.append('    "%s" [%s];' % (package, " ".join(attrs)))
+    for level in analysis["levels"]:
+        lines.append("    { rank=same; %s }" % " ".join('"%s";' % package for package in level))
+    for package, node in analysis["packages"].items():
+        for dep in node["deps"]:
+            style = " [color=red penwidth=2]" if (dep, package) in critical_edges else ""
+            lines.append('    "%s" -> "%s"%s;' % (dep, package, style))
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def export_graph(dep_manager, packages, path):
+    """Write the analysed dependency graph to path, as DOT if it ends .dot, otherwise JSON, and summarise it"""
+    graph = dependency_graph(dep_manager, packages)
+    analysis = analyse_graph(packages, graph, estimate_durations(packages))
+    if path.endswith(".dot"):
+        Path(path).write_text(graph_to_dot(analysis))
+    else:
+        Path(path).write_text(json.dumps(analysis, indent=1))
+
+    print(f"{len(packages)} packages in {len(analysis['levels'])} levels, widths " +
+          " ".join(str(width) for width in analysis["width"]))
+    print(f"Critical path {format_seconds(analysis['critical_path']['seconds'])} of "
+          f"{format_seconds(analysis['total_seconds'])} work: " + " -> ".join(analysis["critical_path"]["packages"]))
+    print("At most %d bots busy at once, %.1f on average" % (analysis["max_parallelism"],
+                                                             analysis["average_parallelism"]))
+    if analysis["serial"]:
+        print("Built with nothing else running: " + " ".join(analysis["serial"]))
 
 
 def read_packages_from_stdin(slackbuilds):
@@ -789,30 +2657,77 @@ def read_packages_from_stdin(slackbuilds):
     return out
 
 
+def configure_limits(args):
+    """Set up the download limiter and admission control from the command-line"""
+    DOWNLOADS.configure(int(args.numthreads) if args.getinparallel else 1, int(args.perhost),
+                        parse_rate(args.bandwidth) if args.bandwidth else None, HOSTS_CONF)
+    ADMISSION.configure(int(args.reservememory), float(args.maxload) if args.maxload else None, load_stats())
+    defaults = {"build": args.buildtimeout, "download": args.downloadtimeout, "idle": args.idletimeout}
+    TIMEOUTS.configure({step: parse_duration(value) for step, value in defaults.items() if value}, TIMEOUTS_CONF)
+
+
 def build_packages(args):
 
     LOCAL_AFTERPKG_DIR.mkdir(exist_ok=True, parents=True)
 
-    global g_ssh_host
-    global g_ssh_port
-    g_ssh_host = args.targethost
-    g_ssh_port = args.targetport
+    global g_backend
+    if args.simulated:
+        g_backend = SimulatedBackend(durations=load_stats(), speedup=float(args.speedup))
+    elif args.targethost:
+        g_backend = SshBackend(args.targethost, args.targetport)
+    else:
+        g_backend = LocalBackend()
 
     if "-" in args.packages:
         packages = read_packages_from_stdin(args.packages)
     else:
         packages = args.packages
 
-    dep_manager = DependencyManager(Path(args.slackbuilds), args.novirtual)
+    if args.sync:
+        sync_and_report(args.sync, Path(args.slackbuilds))
+        if not packages:
+            return
+
+    if args.daemon:
+        configure_limits(args)
+        Daemon(args).serve()
+        return
+
+    if args.connect:
+        reply = daemon_request({"command": "queue" if args.queue else "build", "packages": packages})
+        if "error" in reply:
+            print(reply["error"], file=sys.stderr)
+            sys.exit(1)
+        for package in reply.get("packages", []):
+            print(package)
+        if reply.get("failed"):
+            print("Failed: %s" % " ".join(reply["failed"]), file=sys.stderr)
+            sys.exit(1)
+        return
+
+    dep_manager = timed("scan", lambda: DependencyManager(Path(args.slackbuilds), args.novirtual, None, args.nopip2,
+                                                          args.nopip3))
     scripts = ScriptManager(find_scripts_location(), args)
 
-    resolved = dep_manager.resolve_dependencies(packages, True)
+    resolved = timed("resolve", lambda: dep_manager.resolve_dependencies(packages, True))
+    if args.timing:
+        # On stderr, to keep -q output clean.
+        for phase, seconds in g_phase_times:
+            print("%-20s %8.4fs" % (phase, seconds), file=sys.stderr)
 
     if args.queue:
         for package in resolved:
             print(package)
+    elif args.predict:
+        print_schedule_prediction(dep_manager, resolved, int(args.predict))
+    elif args.export:
+        export_graph(dep_manager, resolved, args.export)
     else:
-        start_build_engine(dep_manager, resolved, scripts, args)
+        configure_limits(args)
+        backend = engine_backend(args)
+        start_build_engine(dep_manager, resolved, scripts, args, backend, delta=not args.fulltransfer)
+        if args.repository and not args.onlydownload:
+            assemble_repository(backend, args.repository)
 
 
 def main():
@@ -864,7 +2779,16 @@ def main():
                              "dependent packages.")
     parser.add_argument("-g", "--getinparallel", default=False, action="store_true",
                         help="Normally downloads will be one-by-one.  This will run them in parallel (up to "
-                        "--numthreads)")
+                        "--numthreads), but no more than --perhost at a time from the same host")
+    parser.add_argument("--perhost", default="2", metavar="CONNECTIONS",
+                        help="With -g, the most downloads to run at once from any one host (default 2).  Hosts can "
+                        f"be given their own limit in ~/.{PROGNAME}/hosts.conf, a section per host (globs allowed) "
+                        "with a 'connections' setting, e.g. one for [*.sourceforge.net]")
+    parser.add_argument("--bandwidth", default=None, metavar="RATE",
+                        help="Ceiling on the total download rate, e.g. 500k or 2m bytes per second, split evenly "
+                        "between the download slots (1, or --numthreads with -g).  Keeps downloads from starving "
+                        "the target's builds.  "
+                        f"Per-host throughput is recorded in ~/.{PROGNAME}/hosts.json either way")
     parser.add_argument("-q", "--queue", default=False, action="store_true",
                         help=f"Just print the queue of builds, similar to what sqg would generate. You can use "
                         f"{PROGNAME} to only compute dependencies, generate an sbopkg queue and then run the builds "
@@ -878,12 +2802,92 @@ def main():
                         help="Specify the remote port for the target.  This is useful if you've forwarded ports from "
                         "a virtual machine to the host e.g. 22 -> 2222  ")
 
-    parser.add_argument("packages", default=False, nargs="+",
+    parser.add_argument("-S", "--simulated", default=False, action="store_true",
+                        help="Run against a simulated target instead of this host or --targethost.  Nothing is "
+                        "downloaded, built or installed, each step takes the time it took on earlier real runs (or "
+                        "no time at all).  Useful for exercising the build engine with large queues.")
+    parser.add_argument("-x", "--speedup", default="1", metavar="FACTOR",
+                        help="With --simulated, run the simulated steps this many times faster than recorded "
+                        "(default 1)")
+    parser.add_argument("-m", "--predict", default=None, metavar="MAXTHREADS",
+                        help="Don't build anything, predict how long the queue would take to build with 1 up to "
+                        "MAXTHREADS bots.  Uses the timings recorded on earlier runs, "
+                        "or a guess from the size of the downloaded sources.  Also shows the critical path, the "
+                        "chain of dependent builds that no number of threads can shorten.")
+    parser.add_argument("-e", "--export", default=None, metavar="FILE",
+                        help="Don't build anything, write the dependency graph of the queue to FILE, in graphviz DOT "
+                        "format if FILE ends .dot, otherwise JSON.  Each package gets its level in the graph and its "
+                        "estimated start and finish with unlimited threads.  Also shows the width of each level, "
+                        "the critical path, the most bots that could be kept busy, and the packages that build "
+                        "with nothing else running.")
+    parser.add_argument("-F", "--fulltransfer", default=False, action="store_true",
+                        help="At the start of a run the SlackBuild directories and build scripts for the whole "
+                        f"queue are sent to ~/.{PROGNAME}/staging on the target in one go, skipping any the target "
+                        "already has.  This option sends them all regardless.")
+    parser.add_argument("-R", "--resume", default=False, action="store_true",
+                        help=f"Carry on from where an interrupted run stopped.  Steps are journalled in "
+                        f"~/.{PROGNAME}/journal.log as they finish, with this option packages already installed "
+                        "are skipped, ones already built are just installed and ones already downloaded aren't "
+                        "checked again, unless their .info VERSION or MD5SUM has changed since.  Give the same "
+                        "packages as the interrupted run.")
+    parser.add_argument("--statusport", default=None, metavar="PORT",
+                        help=f"Serve the live build status as JSON on http://127.0.0.1:PORT/ as well as on the "
+                        f"~/.{PROGNAME}/status.sock Unix socket (status-HOST.sock with --targethost).")
+
+    parser.add_argument("--reservememory", default="256", metavar="MB",
+                        help="Memory to leave free on the target (default 256).  A build is only started if its "
+                        "peak memory, as measured on earlier runs, fits in what's available less this and the peaks "
+                        "of the builds already running.  Heavy builds are held back while lighter ones go ahead, "
+                        "and anything is started when nothing else is building.")
+    parser.add_argument("--maxload", default=None, metavar="LOAD",
+                        help="Don't start another build while the target's load average is LOAD or more")
+    parser.add_argument("--buildtimeout", default=None, metavar="DURATION",
+                        help="Kill a build still running after DURATION (seconds, or with an m, h or d suffix) and "
+                        "mark the package failed")
+    parser.add_argument("--downloadtimeout", default=None, metavar="DURATION",
+                        help="Kill a download still running after DURATION")
+    parser.add_argument("--idletimeout", default=None, metavar="DURATION",
+                        help="Kill any step of a job that prints nothing for DURATION, so a hung configure test or "
+                        "a stalled download doesn't hold on to a bot.  All three can be set per package in "
+                        f"~/.{PROGNAME}/timeouts.conf.")
+    parser.add_argument("--pkgtype", default=None, choices=["tgz", "tbz", "tlz", "txz"],
+                        help="Package format for the SlackBuilds to make (PKGTYPE), by default whatever each "
+                        "SlackBuild chooses, usually tgz.  "
+                        f"The time makepkg takes is recorded as 'package' in ~/.{PROGNAME}/stats.json either way.")
+    parser.add_argument("--repository", default=None, metavar="DIR",
+                        help="Copy every package built into DIR on the target, laid out as a Slackware package "
+                        "repository: DIR/<category>/ holds the packages and their .txt descriptions, and DIR has "
+                        "PACKAGES.TXT and CHECKSUMS.md5, so other hosts can install the binaries with slackpkg+ or "
+                        "similar.  Older versions of a package are removed as newer ones arrive.")
+    parser.add_argument("-T", "--timing", default=False, action="store_true",
+                        help="Show how long each phase of startup took: scanning the slackbuild directory, fetching "
+                        "the pypi, pip and installed package lists (only done if the dependencies need them) and "
+                        "resolving the queue, which includes any lists fetched while resolving.")
+    parser.add_argument("-D", "--daemon", default=False, action="store_true",
+                        help=f"Run as a daemon, taking requests on ~/.{PROGNAME}/daemon.sock.  The slackbuild "
+                        "directory, pypi list and package inventory are kept in memory (the directory is rescanned "
+                        "when it changes), and the builds of all requests share one set of --numthreads bots, so a "
+                        "package asked for by two requests at once is only built once.  The other options given "
+                        "with -D apply to every request.")
+    parser.add_argument("-C", "--connect", default=False, action="store_true",
+                        help="Hand the packages (or -q) to a running daemon rather than doing the work here")
+    parser.add_argument("-y", "--sync", default=None, metavar="SOURCE",
+                        help="Update the slackbuild directory from SOURCE, a git checkout or a zip/tar archive of a "
+                        "SlackBuilds tree (such as the ponce current.zip) first.  Only package directories that "
+                        "changed are copied, and the installed packages that changed or depend on something that "
+                        "changed are listed.  Packages to build are optional with this option.")
+
+    parser.add_argument("packages", nargs="*",
                         help="Package(s) to build.  If dash '-' is specified, reads package list from stdin, "
                         "one-per-line Hash characters '#' will be considered comments and those lines (or ends of "
                         "lines) will be ignored.")
 
     args = parser.parse_args()
+    if not args.packages and not args.sync and not args.daemon:
+        parser.error("no packages given")
+    # Builds run in process groups of their own, so they don't see Ctrl-C.  Take them down with us, on a kill too.
+    atexit.register(CHILDREN.kill_all)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
     build_packages(args)
 
 
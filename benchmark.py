@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+    Copyright(c) 2020 bifferos@gmail.com UK
+    All rights reserved.
+
+    Redistribution and use of this script, with or without modification, is
+    permitted provided that the following conditions are met:
+
+    1. Redistributions of this script must retain the above copyright
+       notice, this list of conditions and the following disclaimer.
+
+     THIS SOFTWARE IS PROVIDED BY THE AUTHOR "AS IS" AND ANY EXPRESS OR IMPLIED
+     WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+     MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO
+     EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+     SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+     PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+     OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+     WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR
+     OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+     ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+    benchmark
+
+    Time the afterpkg internals against a synthetic SlackBuilds tree, so changes to the dependency manager or
+    the build engine can be checked for slowdowns.  Everything runs offline: the tree, the pypi list and the
+    pip/installed package inventory are all generated.  Results are appended to a JSON-lines file so they can
+    be compared from run to run.
+
+"""
+
+import argparse
+import json
+import random
+import sys
+import tempfile
+import time
+from argparse import Namespace
+from pathlib import Path
+from subprocess import Popen, PIPE
+
+import afterpkg
+
+
+PROGNAME = "benchmark"
+
+RESULTS_FILE = afterpkg.LOCAL_AFTERPKG_DIR / "benchmarks.jsonl"
+
+CATEGORIES = ["academic", "audio", "desktop", "development", "libraries", "multimedia", "network", "system"]
+
+
+info_template = """PRGNAM="%(package)s"
+VERSION="%(version)s"
+HOMEPAGE="https://example.org/%(package)s"
+DOWNLOAD="https://example.org/src/%(package)s-%(version)s.tar.gz"
+MD5SUM="%(md5)s"
+DOWNLOAD_x86_64=""
+MD5SUM_x86_64=""
+REQUIRES="%(requires)s"
+MAINTAINER="Nobody"
+EMAIL="nobody@example.org"
+"""
+
+
+build_template = """#!/bin/sh
+PRGNAM=%(package)s
+VERSION=${VERSION:-%(version)s}
+%(install)s
+"""
+
+
+def generate_tree(root, count, fanout, depth, python_fraction, rng):
+    """
+        Write a synthetic SBo tree of count packages under root.  Packages are spread over depth layers and each
+        one requires up to fanout packages from the layers below it.  Returns the list of package names and the
+        python subset.
+    """
+    names = []
+    python_names = set()
+    layers = [[] for _ in range(depth)]
+    for index in range(count):
+        layer = index * depth // count
+        if rng.random() < python_fraction:
+            name = "python3-pkg%05d" % index
+            category = "python"
+            python_names.add(name)
+            install = "python3 setup.py install --root=$PKG"
+        else:
+            name = "pkg%05d" % index
+            category = rng.choice(CATEGORIES)
+            install = "make install DESTDIR=$PKG"
+
+        below = [dep for lower in layers[:layer] for dep in lower]
+        requires = rng.sample(below, min(len(below), rng.randint(0, fanout)))
+        layers[layer].append(name)
+        names.append(name)
+
+        fields = {
+            "package": name,
+            "version": "1.%d" % rng.randint(0, 20),
+            "md5": "%032x" % rng.getrandbits(128),
+            "requires": " ".join(requires),
+            "install": install,
+        }
+        package_dir = root / category / name
+        package_dir.mkdir(parents=True)
+        (package_dir / (name + ".info")).write_text(info_template % fields)
+        (package_dir / (name + ".SlackBuild")).write_text(build_template % fields)
+    return names, python_names
+
+
+def fake_inventory(names, python_names, pypi_size, pip_fraction, installed_fraction, rng):
+    """An Inventory that looks like a partly-populated host, with a pypi list of roughly pypi_size entries"""
+    pypi_all = ["filler-%06d" % i for i in range(max(0, pypi_size - len(python_names)))]
+    pypi_all += [name.partition("-")[2] for name in sorted(python_names)]
+    rng.shuffle(pypi_all)
+    pip3 = {name.partition("-")[2] for name in sorted(python_names) if rng.random() < pip_fraction}
+    installed = {name for name in names if rng.random() < installed_fraction}
+    return afterpkg.Inventory(pypi_all, set(), pip3, installed)
+
+
+def noop_bot(job_q, done_q, dep_manager, console, scripts, bot_index, args, backend, status, journal):
+    """A bot that completes every job straight away, to measure the scheduler on its own"""
+    while True:
+        package = job_q.get(True)
+        if package is None:
+            return
+        done_q.put((package, True))
+
+
+def best_of(repeat, func):
+    """Run func repeat times, return the fastest time and the last result"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def run_benchmarks(root, names, python_names, inventory, args):
+    timings = {}
+
+    timings["scan"], dep_manager = best_of(args.repeat, lambda: afterpkg.DependencyManager(root, False, inventory))
+
+    def parse_all():
+        afterpkg.g_info_cache.clear()
+        for name in names:
+            afterpkg.read_info(dep_manager.get_source_location(name) / (name + ".info"))
+    timings["info"], _ = best_of(args.repeat, parse_all)
+
+    def match_all():
+        return [dep_manager.sbo_to_pypi(name) for name in python_names]
+    timings["pypi_match"], _ = best_of(args.repeat, match_all)
+
+    # Asking for the top layer pulls in most of the tree.
+    wanted = names[-max(1, len(names) // args.depth):]
+    timings["resolve"], resolved = best_of(args.repeat, lambda: dep_manager.resolve_dependencies(wanted, True))
+
+    engine_args = Namespace(numthreads=str(args.numthreads), nocolour=True, donothing=False, resume=False,
+                            onlydownload=False)
+    scripts_dir = root.parent / "scripts"
+    scripts_dir.mkdir(exist_ok=True)
+    scripts = afterpkg.ScriptManager(scripts_dir, Namespace(before=False, after=False, requires=False))
+    backend = afterpkg.LocalBackend()
+
+    def stage_all():
+        backend.remove_tree(afterpkg.STAGING_DIR)
+        afterpkg.stage_build_files(backend, dep_manager, scripts, resolved)
+    timings["stage"], _ = best_of(args.repeat, stage_all)
+    timings["stage_delta"], _ = best_of(args.repeat, lambda: afterpkg.stage_build_files(backend, dep_manager,
+                                                                                         scripts, resolved))
+
+    timings["schedule"], _ = best_of(args.repeat, lambda: afterpkg.start_build_engine(dep_manager, resolved, scripts,
+                                                                                   engine_args, backend, noop_bot))
+    return timings, len(resolved)
+
+
+def git_revision():
+    p = Popen("git rev-parse --short HEAD", stdout=PIPE, stderr=PIPE, shell=True, cwd=sys.path[0])
+    sout, _ = p.communicate()
+    return sout.decode("utf-8").strip() or None
+
+
+def previous_result(results_file, params):
+    """The most recent recorded result with the same parameters, or None"""
+    if not results_file.exists():
+        return None
+    previous = None
+    for line in results_file.open("r"):
+        record = json.loads(line)
+        if record["params"] == params:
+            previous = record
+    return previous
+
+
+def main():
+    parser = argparse.ArgumentParser(prog=f'{PROGNAME}',
+                                     description="Benchmark afterpkg against a synthetic SlackBuilds tree.  Runs "
+                                     "offline, nothing is downloaded, built or installed.")
+    parser.add_argument("-p", "--packages", default=300, type=int,
+                        help="Number of packages in the generated tree (default 300)")
+    parser.add_argument("-f", "--fanout", default=4, type=int,
+                        help="Maximum number of REQUIRES per package (default 4)")
+    parser.add_argument("-l", "--depth", default=8, type=int,
+                        help="Number of dependency layers (default 8)")
+    parser.add_argument("-y", "--python", default=0.3, type=float,
+                        help="Fraction of packages that are python3- packages (default 0.3)")
+    parser.add_argument("-i", "--installed", default=0.1, type=float,
+                        help="Fraction of packages already installed on the fake host (default 0.1)")
+    parser.add_argument("-3", "--pip3", default=0.2, type=float,
+                        help="Fraction of python packages already pip3-installed (default 0.2)")
+    parser.add_argument("-P", "--pypisize", default=10000, type=int,
+                        help="Size of the fake pypi package list (default 10000)")
+    parser.add_argument("-n", "--numthreads", default=4, type=int,
+                        help="Number of no-op bots for the scheduler benchmark (default 4)")
+    parser.add_argument("-r", "--repeat", default=3, type=int,
+                        help="Repeat each measurement, keeping the fastest (default 3)")
+    parser.add_argument("-s", "--seed", default=1, type=int,
+                        help="Random seed, keep it fixed to compare runs (default 1)")
+    parser.add_argument("-o", "--results", default=str(RESULTS_FILE),
+                        help=f"JSON-lines file to append results to (default {RESULTS_FILE})")
+    parser.add_argument("-x", "--norecord", default=False, action="store_true",
+                        help="Don't append the results to the results file")
+    args = parser.parse_args()
+
+    params = {name: getattr(args, name) for name in ["packages", "fanout", "depth", "python", "installed", "pip3",
+                                                      "pypisize", "numthreads", "seed"]}
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory(prefix=f"{PROGNAME}-") as temp:
+        temp = Path(temp)
+        # Keep the engine's status socket, staging and bot directories away from the real ~/.afterpkg
+        afterpkg.STATUS_SOCKET = temp / "status.sock"
+        afterpkg.JOURNAL_FILE = temp / "journal.log"
+        afterpkg.INDEX_FILE = temp / "index.pickle"
+        afterpkg.STAGING_DIR = temp / "staging"
+        afterpkg.BOT_WORKING_DIRS = temp / "bots"
+
+        root = temp / "slackbuilds"
+        names, python_names = generate_tree(root, args.packages, args.fanout, args.depth, args.python, rng)
+        inventory = fake_inventory(names, python_names, args.pypisize, args.pip3, args.installed, rng)
+        timings, resolved_count = run_benchmarks(root, names, python_names, inventory, args)
+
+    results_file = Path(args.results)
+    previous = previous_result(results_file, params)
+
+    print(f"{len(names)} packages, {len(python_names)} python, {resolved_count} resolved for build")
+    for name, seconds in timings.items():
+        line = "%-12s %10.4fs" % (name, seconds)
+        if previous and name in previous["timings"] and previous["timings"][name]:
+            line += "  %+7.1f%% vs %s" % (100.0 * (seconds / previous["timings"][name] - 1),
+                                          previous["revision"] or previous["time"])
+        print(line)
+
+    if not args.norecord:
+        record = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": git_revision(),
+            "params": params,
+            "timings": timings,
+        }
+        results_file.parent.mkdir(exist_ok=True, parents=True)
+        with results_file.open("a") as fp:
+            fp.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
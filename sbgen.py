@@ -23,35 +23,94 @@
 
     sbgen
 
-    Generate a Slackware build to install a given Python package using pip.
-    Note this doesn't generate a .info file but that can easily be added, it's
-    not strictly needed, you still need to obtain your 'source' by running
-    something like:
+    Generate Slackware builds to install Python packages using pip.  Each
+    package gets its own directory with the SlackBuild, .info, slack-desc,
+    README, doinst.sh and douninst.sh, plus the 'source' fetched with:
 
     $ pip download  <pypi name>
     $ pip3 download  <pypi name>
 
+    Package metadata comes from the pypi JSON API and is cached in
+    ~/.sbgen/cache, revalidated with the ETag on each run.  Point --index at a
+    local server to run against a mock index.
+
+    With --recursive the requires_dist of each package is followed (evaluating
+    environment markers for the target Python) and wrappers are generated for
+    every dependency that doesn't already have one, with REQUIRES filled in so
+    afterpkg can schedule the whole set.  Dependencies SBo already has as
+    python3-<name> or python-<name> are required under those names instead.
+
 """
 
 import os
 import argparse
+import json
+import re
+import sys
 import textwrap
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
-import xmlrpc.client as xmlrpclib
+from subprocess import Popen, PIPE, STDOUT
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+try:
+    from packaging.markers import default_environment
+    from packaging.requirements import Requirement
+except ImportError:
+    # Only needed to follow requirements with -R, see main()
+    default_environment = Requirement = None
 
 
 PROGNAME = "sbgen"
 
+INDEX_URL = "https://pypi.org/pypi"
+CACHE_DIR = Path(os.path.expanduser(f"~/.{PROGNAME}/cache"))
+SLACKBUILDS_DIR = Path(os.path.expanduser("~/.afterpkg/slackbuilds"))
+
+
+# The wheelhouse is laid out as a PEP 503 simple index, a directory per project with an index.html, so pip
+# only looks at the files of the projects it needs.  Each package updates the index for just the projects it
+# ships when it's installed or removed.  The SlackBuild fills in @PROJECTS@.
+index_template = """
+WHEELHOUSE=/opt/afterpkg-python/simple
+
+update_index() {
+  project=$1
+  files=$(cd $WHEELHOUSE/$project 2> /dev/null && ls | grep -v '^index.html$')
+  if [ -z "$files" ]; then
+    rm -rf $WHEELHOUSE/$project
+    if [ -f $WHEELHOUSE/index.html ]; then
+      sed -i "/>$project<\\/a>/d" $WHEELHOUSE/index.html
+    fi
+    return
+  fi
+  ( echo "<!DOCTYPE html>"
+    for f in $files; do
+      echo "<a href='$f'>$f</a><br>"
+    done ) > $WHEELHOUSE/$project/index.html
+  if [ ! -f $WHEELHOUSE/index.html ]; then
+    echo "<!DOCTYPE html>" > $WHEELHOUSE/index.html
+  fi
+  if ! grep -q ">$project</a>" $WHEELHOUSE/index.html; then
+    echo "<a href='$project/'>$project</a><br>" >> $WHEELHOUSE/index.html
+  fi
+}
+
+for project in @PROJECTS@ ; do
+  update_index $project
+done
+"""
 
-do_install_template = """
-pip install --no-index --find-links /opt/afterpkg-python %(package)s
-pip3 install --no-index --find-links /opt/afterpkg-python %(package)s
+do_install_template = index_template + """
+pip install --index-url file://$WHEELHOUSE %(package)s
+pip3 install --index-url file://$WHEELHOUSE %(package)s
 """
 
 do_uninstall_template = """
 pip uninstall %(package)s
 pip3 uninstall %(package)s
-"""
+""" + index_template
 
 
 build_template = """#!/bin/sh
@@ -100,15 +159,29 @@ mkdir -p $PKG/usr/doc/$PRGNAM-$VERSION
 cp -a $CWD/README $PKG/usr/doc/$PRGNAM-$VERSION
 cat $CWD/$PRGNAM.SlackBuild > $PKG/usr/doc/$PRGNAM-$VERSION/$PRGNAM.SlackBuild
 
+# File each wheel and sdist under its normalised project name.
+PROJECTS=""
+for f in $CWD/*.whl $CWD/*.tar.gz $CWD/*.zip ; do
+  [ -e "$f" ] || continue
+  name=$(basename $f)
+  case "$name" in
+    *.whl) project=$(echo $name | cut -d - -f 1) ;;
+        *) project=$(echo $name | sed 's/-[^-]*$//') ;;
+  esac
+  project=$(echo $project | tr 'A-Z' 'a-z' | sed 's/[-_.][-_.]*/-/g')
+  mkdir -p $PKG/opt/afterpkg-python/simple/$project
+  cp $f $PKG/opt/afterpkg-python/simple/$project/
+  case " $PROJECTS " in
+    *" $project "*) ;;
+    *) PROJECTS="$PROJECTS $project" ;;
+  esac
+done
+
 mkdir -p $PKG/install
-mkdir -p $PKG/opt/afterpkg-python
 cat $CWD/slack-desc > $PKG/install/slack-desc
-cat $CWD/doinst.sh > $PKG/install/doinst.sh
+sed "s/@PROJECTS@/$PROJECTS/" $CWD/doinst.sh > $PKG/install/doinst.sh
 mkdir -p $PKG/var/lib/pkgtools/douninst.sh
-cat $CWD/douninst.sh > $PKG/var/lib/pkgtools/douninst.sh/$PRGNAM-$VERSION-$ARCH-$BUILD$TAG
-
-cp $CWD/*.whl $PKG/opt/afterpkg-python/ | true
-cp $CWD/*.gz $PKG/opt/afterpkg-python/ | true
+sed "s/@PROJECTS@/$PROJECTS/" $CWD/douninst.sh > $PKG/var/lib/pkgtools/douninst.sh/$PRGNAM-$VERSION-$ARCH-$BUILD$TAG
 
 
 cd $PKG
@@ -149,7 +222,7 @@ DOWNLOAD="%(url)s"
 MD5SUM="%(md5_digest)s"
 DOWNLOAD_x86_64=""
 MD5SUM_x86_64=""
-REQUIRES=""
+REQUIRES="%(requires)s"
 MAINTAINER="Bifferos"
 EMAIL="bifferos@gmail.com"
 """
@@ -157,38 +230,70 @@ EMAIL="bifferos@gmail.com"
 DESC_LINE_WIDTH = 70
 
 
-def get_info(package):
+def fetch_metadata(package, index_url=INDEX_URL):
     """
-        Download and cache the entire list of packages from pypi.  This takes a couple of seconds but it's cached
-        to be considerate to the server.  You'll need to periodically delete the downloaded file yourself.
+        Fetch the JSON API document for package.  Responses are cached on disk along with their ETag, so a repeat
+        fetch only costs a 304 from the server, and the cached copy is used if the server can't be reached.
     """
-    #print("Downloading package list from pypi")
-    client = xmlrpclib.ServerProxy('https://pypi.python.org/pypi')
-    # get a list of package names
-    release = client.package_releases(package)[0]
-
-    data = client.release_data(package, release)
-    description  = data["description"]
+    cache = CACHE_DIR / (package.lower() + ".json")
+    etag_file = CACHE_DIR / (package.lower() + ".etag")
+
+    request = Request(f"{index_url}/{package}/json")
+    if cache.exists() and etag_file.exists():
+        request.add_header("If-None-Match", etag_file.read_text())
+    try:
+        with urlopen(request, timeout=60) as response:
+            body = response.read()
+            etag = response.headers.get("ETag")
+    except HTTPError as e:
+        if e.code == 304:
+            return json.loads(cache.read_text())
+        raise
+    except URLError:
+        if cache.exists():
+            return json.loads(cache.read_text())
+        raise
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    temp = cache.with_suffix(".tmp%d" % os.getpid())
+    temp.write_bytes(body)
+    temp.replace(cache)
+    if etag:
+        etag_file.write_text(etag)
+    else:
+        etag_file.unlink(missing_ok=True)
+    return json.loads(body)
+
+
+def get_info(package, index_url=INDEX_URL):
+    """
+        Work out the template fields for package from its pypi metadata.
+    """
+    metadata = fetch_metadata(package, index_url)
+    data = metadata["info"]
+    release = data["version"]
+    description = data["description"] or ""
 
     fields = {
-        "summary": data["summary"],
+        "summary": data["summary"] or "",
         "package": package,
         "pad": " "*len(package),
         "version": release,
-        "home_page": data["home_page"]
+        "home_page": data["home_page"] or data["project_url"] or "",
+        "requires_dist": data["requires_dist"] or [],
+        "source": "",
+        "url": "",
+        "md5_digest": "",
+        "requires": "",
     }
 
-    for item in data["requires_dist"]:
-        print(item)
-
-    urls = client.release_urls(package, release)
-    for url in urls:
+    for url in metadata["urls"]:
         if url["packagetype"] == 'sdist':
             fields["source"] = url["filename"]
             fields["url"] = url["url"]
-            fields["md5_digest"] = url["md5_digest"]
+            fields["md5_digest"] = url["digests"]["md5"]
 
-    readme = data["summary"] + "\n\n"
+    readme = fields["summary"] + "\n\n"
 
     lines = []
     for line in description.split("\n"):
@@ -232,31 +337,186 @@ def get_info(package):
 
 
 def render_template(name, template, fields):
-    print("Writing %r" % name)
+    print("Writing %r" % str(name))
     Path(name).open("wb").write((template % fields).encode("utf-8"))
 
 
-def generate_build(package):
-    os.system("pip download %s" % package)
-    os.system("pip3 download %s" % package)
+def canonical_name(name):
+    """The PEP 503 normalised form of a project name"""
+    return re.sub(r"[-_.]+", "-", name).lower()
 
-    fields = get_info(package)
-    render_template("doinst.sh", do_install_template, fields)
-    render_template("douninst.sh", do_uninstall_template, fields)
-    render_template("README", readme_template, fields)
-    render_template("slack-desc", desc_template, fields)
-    render_template(package + ".SlackBuild", build_template, fields)
-    render_template(package + ".info", info_template, fields)
+
+def marker_environment(python_version=None):
+    """Environment to evaluate requirement markers in, for the given target python version (e.g. '3.9')"""
+    environment = default_environment()
+    if python_version:
+        environment["python_version"] = ".".join(python_version.split(".")[:2])
+        environment["python_full_version"] = python_version if python_version.count(".") >= 2 \
+            else python_version + ".0"
+    return environment
+
+
+def required_packages(requires_dist, environment):
+    """Canonical names of the requirements that apply in environment, ignoring those only wanted for extras"""
+    out = []
+    for text in requires_dist:
+        requirement = Requirement(text)
+        if requirement.marker and not requirement.marker.evaluate(dict(environment, extra="")):
+            continue
+        name = canonical_name(requirement.name)
+        if name not in out:
+            out.append(name)
+    return out
+
+
+def sbo_packages(root):
+    """
+        {canonical project name: SBo package name} of the python packages in the SlackBuilds tree at root, the
+        python3- ones preferred to the python- ones.
+    """
+    out = {}
+    if not Path(root).is_dir():
+        return out
+    for prefix in ["python-", "python3-"]:
+        for path in Path(root).glob(f"*/{prefix}*"):
+            if path.is_dir():
+                out[canonical_name(path.name[len(prefix):])] = path.name
+    return out
+
+
+def download_sources(package, dest, no_deps=False):
+    """Run pip and pip3 download side by side, return a list of error messages"""
+    options = ["--no-deps"] if no_deps else []
+    processes = [(pip, Popen([pip, "download", "--quiet", "-d", str(dest)] + options + [package],
+                             stdout=PIPE, stderr=STDOUT))
+                 for pip in ["pip", "pip3"]]
+    errors = []
+    for pip, p in processes:
+        out, _ = p.communicate()
+        if p.returncode != 0:
+            errors.append(f"{pip} download {package} failed:\n" + out.decode("utf-8", "replace"))
+    return errors
+
+
+def generate_build(package, outdir, index_url=INDEX_URL, download=True, environment=None, existing=None):
+    """
+        Write the wrapper for package into outdir/package, return a list of error messages and the list of
+        packages it requires.  The requirements are only worked out, and put in the .info file, if given the
+        marker environment of the target.  The download then skips dependencies as they get their own wrappers.
+        Requirements SBo already has, in existing ({project: SBo name}), go into REQUIRES under their SBo names.
+    """
+    fields = get_info(package, index_url)
+    requires = []
+    if environment is not None:
+        requires = [name for name in required_packages(fields["requires_dist"], environment)
+                    if name != canonical_name(package)]
+        fields["requires"] = " ".join((existing or {}).get(name, name) for name in requires)
+
+    dest = Path(outdir) / package
+    dest.mkdir(parents=True, exist_ok=True)
+    render_template(dest / "doinst.sh", do_install_template, fields)
+    render_template(dest / "douninst.sh", do_uninstall_template, fields)
+    render_template(dest / "README", readme_template, fields)
+    render_template(dest / "slack-desc", desc_template, fields)
+    render_template(dest / (package + ".SlackBuild"), build_template, fields)
+    render_template(dest / (package + ".info"), info_template, fields)
+
+    errors = []
+    if download:
+        errors = download_sources(package, dest, environment is not None)
+    return errors, requires
+
+
+def generate_builds(packages, outdir, index_url=INDEX_URL, download=True, jobs=8, environment=None,
+                    slackbuilds=SLACKBUILDS_DIR):
+    """
+        Generate wrappers for all the packages concurrently, return True if they all worked.  If given the marker
+        environment of the target, carry on through the whole dependency closure, generating wrappers for any
+        required package that doesn't already have a directory in outdir, or a python3- or python- package
+        anywhere in the slackbuilds tree.
+    """
+    existing = sbo_packages(slackbuilds) if environment is not None else {}
+
+    def generate(package):
+        try:
+            return generate_build(package, outdir, index_url, download, environment, existing)
+        except (OSError, ValueError, KeyError) as e:
+            return [f"{package}: {e}"], []
+
+    if environment is not None:
+        packages = [canonical_name(package) for package in packages]
+    seen = set(packages)
+
+    ok = True
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(generate, package) for package in seen}
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                errors, requires = future.result()
+                for error in errors:
+                    print(error, file=sys.stderr)
+                    ok = False
+                for package in requires:
+                    if package in seen or package in existing or (Path(outdir) / package).exists():
+                        continue
+                    seen.add(package)
+                    futures.add(pool.submit(generate, package))
+    return ok
+
+
+def read_requirements(path):
+    """The project names from a requirements file, ignoring comments, options and version specifiers"""
+    out = []
+    for line in Path(path).read_text().splitlines():
+        text = line.partition("#")[0].strip()
+        if not text or text.startswith("-"):
+            continue
+        m = re.match(r"^[A-Za-z0-9][A-Za-z0-9._-]*", text)
+        if m:
+            out.append(m.group(0))
+    return out
 
 
 def main():
     parser = argparse.ArgumentParser(prog=f'{PROGNAME}',
-            description=f"Generate a SlackBuild wrapper for a pypi python package ")
-    parser.add_argument("package", default=False,
-                        help="pypi name to generate wrapper for")
+            description=f"Generate SlackBuild wrappers for pypi python packages")
+    parser.add_argument("-r", "--requirements", default=None, metavar="FILE",
+                        help="Also generate wrappers for every package named in this requirements file")
+    parser.add_argument("-o", "--outdir", default=".",
+                        help="Directory to put the wrapper directories in (default the current directory)")
+    parser.add_argument("-j", "--jobs", default=8, type=int,
+                        help="How many packages to fetch and download at once (default 8)")
+    parser.add_argument("-i", "--index", default=INDEX_URL, metavar="URL",
+                        help=f"Base URL of the pypi JSON API (default {INDEX_URL})")
+    parser.add_argument("-n", "--nodownload", default=False, action="store_true",
+                        help="Don't pip download the sources, only write the wrapper files")
+    parser.add_argument("-R", "--recursive", default=False, action="store_true",
+                        help="Also generate wrappers for all the dependencies that don't already have one in the "
+                        "output directory, and fill in REQUIRES.  Names are normalised as in PEP 503.  Needs the "
+                        "python packaging module.")
+    parser.add_argument("-s", "--slackbuilds", default=str(SLACKBUILDS_DIR), metavar="DIR",
+                        help="With --recursive, the SlackBuilds tree to look for existing python3-<name> and "
+                        "python-<name> packages in, which are used instead of generating wrappers "
+                        f"(default {SLACKBUILDS_DIR})")
+    parser.add_argument("-p", "--python", default=None, metavar="VERSION",
+                        help="With --recursive, the python version of the target (e.g. 3.9) to evaluate "
+                        "requirement markers for, default the running python")
+    parser.add_argument("packages", default=[], nargs="*",
+                        help="pypi names to generate wrappers for")
 
     args = parser.parse_args()
-    generate_build(args.package)
+    packages = list(args.packages)
+    if args.requirements:
+        packages += read_requirements(args.requirements)
+    if not packages:
+        parser.error("no packages given")
+    if args.recursive and Requirement is None:
+        parser.error("-R needs the python 'packaging' module (python3-packaging on SBo, or pip install packaging)")
+    environment = marker_environment(args.python) if args.recursive else None
+    if not generate_builds(packages, args.outdir, args.index, not args.nodownload, args.jobs, environment,
+                           Path(args.slackbuilds)):
+        sys.exit(1)
 
 
 if __name__ == "__main__":